@@ -0,0 +1,250 @@
+import asyncio
+import json
+import time
+import numpy as np
+
+from machine_interface import (BlobReader, ChangeWatchers, CompiledTemplate, GCodeError, MachineConnection,
+                               PositionWaiter, VersionedState, check_replies, check_waiters, message_status)
+
+# An asyncio take on MachineConnection: the subscription runs as a task on the
+# caller's event loop instead of a thread, so moves, captures and image processing
+# can be overlapped with plain awaits. Templates and patches work exactly as
+# they do in machine_interface.
+#
+# If the subscription fails (the socket closes, say), nothing more is known
+# about the machine: everything waiting on its state is failed with the error,
+# and every call after that raises it.
+
+
+class AsyncBlobReader(BlobReader):
+    """ BlobReader over an asyncio stream """
+
+    def __init__(self, stream, buffer_size = 65536):
+        super().__init__(None, buffer_size)
+        self.stream = stream
+        self.buffer_size = buffer_size
+
+    async def get(self):
+        while not self.pending:
+            data = await self.stream.read(self.buffer_size)
+            if not data:
+                raise ConnectionError("DSF socket closed")
+            self.buffer += data
+            self.decode()
+        return self.pending.pop(0)
+
+    async def ignore(self):
+        await self.get()
+
+
+def writeblob(writer, obj):
+    writer.write(json.dumps(obj).encode())
+
+
+class AsyncMachineConnection:
+
+    pipeline_window = MachineConnection.pipeline_window
+    busy_timeout = MachineConnection.busy_timeout
+    move_axes = MachineConnection.move_axes
+    move_code = MachineConnection.move_code
+
+    def __init__(self, socket, template = None, recorder = None):
+        self.socket_address = socket
+        self.template = {} if template is None else template
+        self.states = VersionedState(CompiledTemplate(self.template))
+        self.internal_state = {}
+        self.idle_event = asyncio.Event()
+        self.busy_event = asyncio.Event()
+        self.command_lock = asyncio.Lock()
+        self.subscribers = []
+        self.waiters = []
+        self.watchers = ChangeWatchers()
+        self.recorder = recorder
+        self.task = None
+        self.error = None
+
+    async def __aenter__(self):
+        # Subscribe to state updates, and apply the full state before returning
+        reader, self.sub_writer = await asyncio.open_unix_connection(self.socket_address)
+        self.sub_reader = AsyncBlobReader(reader)
+        writeblob(self.sub_writer, {"mode":"subscribe","version": 8, "subscriptionMode": "Patch"})
+        await self.sub_reader.ignore()
+        await self.sub_reader.ignore()
+        self.apply(await self.sub_reader.get())
+        self.task = asyncio.create_task(self.subscription())
+
+        # And a second connection for commands
+        reader, self.writer = await asyncio.open_unix_connection(self.socket_address)
+        self.reader = AsyncBlobReader(reader)
+        writeblob(self.writer, {"mode":"command","version": 8})
+        await self.reader.ignore()
+        await self.reader.ignore()
+
+        return self
+
+    def apply(self, message):
+        changes = self.states.apply(message, self.internal_state)
+        status = message_status(message)
+        if status is not None:
+            if status != 'idle':
+                self.busy_event.set()
+                self.idle_event.clear()
+            else:
+                self.busy_event.clear()
+                self.idle_event.set()
+        if self.waiters:
+            check_waiters(self.waiters, self.internal_state, self.idle_event.is_set())
+        if self.recorder is not None:
+            self.recorder.patch(self.internal_state, self.idle_event.is_set())
+        self.watchers.dispatch(changes)
+
+    async def subscription(self):
+        try:
+            while True:
+                writeblob(self.sub_writer, {"command" : "Acknowledge"})
+                message = await self.sub_reader.get()
+                self.apply(message)
+                for queue in self.subscribers:
+                    queue.put_nowait(message)
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error):
+        """ The subscription has stopped with error: fail every move, when and
+        patches iterator waiting on it, and wake anything in wait_idle """
+        self.error = error
+        for waiter in self.waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(error)
+        self.waiters.clear()
+        self.watchers.fail(error)
+        for queue in self.subscribers:
+            queue.put_nowait(error)
+        self.busy_event.set()
+        self.idle_event.set()
+
+    def check(self):
+        """ Raise the subscription's error, if it's failed """
+        if self.error is not None:
+            raise self.error
+
+    async def patches(self):
+        """ Async iterator over every patch received from now on """
+        queue = asyncio.Queue()
+        self.check()
+        self.subscribers.append(queue)
+        try:
+            while True:
+                message = await queue.get()
+                if isinstance(message, Exception):
+                    raise message
+                yield message
+        finally:
+            self.subscribers.remove(queue)
+
+    async def gcode(self, codes, block = True, pipeline = True, combine = False, on_reply = None):
+        """ As MachineConnection.gcode """
+        self.check()
+        if isinstance(codes, str):
+            codes = [codes]
+        if combine:
+            codes = ['\n'.join(codes)]
+
+        window = self.pipeline_window if pipeline else 1
+        async with self.command_lock:
+            replies, sent, sent_at, depth = [], 0, [], []
+            while len(replies) < len(codes):
+                while sent < len(codes) and sent - len(replies) < window:
+                    sent_at.append(time.time())
+                    depth.append(sent - len(replies))
+                    writeblob(self.writer, {"code" : codes[sent], "channel" : 0, "command" : "SimpleCode"})
+                    sent += 1
+                await self.writer.drain()
+                replies.append(await self.reader.get())
+                n = len(replies) - 1
+                if self.recorder is not None:
+                    self.recorder.command(codes[n], sent_at[n], time.time(), depth[n])
+                if on_reply is not None:
+                    try:
+                        result = check_replies(codes[n:n + 1], replies[n:])[0]
+                    except GCodeError:
+                        on_reply = None
+                    else:
+                        on_reply(n, result)
+
+        results = check_replies(codes, replies)
+        if block:
+            await self.wait_idle()
+        return results
+
+    async def wait_idle(self, busy_timeout = 1):
+        """ Wait for the machine to start moving (for up to busy_timeout seconds)
+        and then to go idle again """
+        self.check()
+        try:
+            await asyncio.wait_for(self.busy_event.wait(), busy_timeout)
+        except asyncio.TimeoutError:
+            return
+        await self.idle_event.wait()
+        self.check()
+
+    async def move(self, *args, **kwargs):
+        """ As MachineConnection.move, except it returns the Settled itself
+        when blocking, and an asyncio future for it otherwise """
+        moves = self.move_axes(*args, **kwargs)
+        if moves is None:
+            return
+        gcode = self.move_code(*args, **kwargs)
+
+        target = {axis.lower(): float(v) for axis, v in moves.items() if axis in 'XYZU'}
+        waiter = PositionWaiter(target, kwargs.get('tolerance', 0.01))
+        await self.gcode(gcode, block = False)
+        self.check()
+        if not waiter.check(self.internal_state, self.idle_event.is_set()):
+            self.waiters.append(waiter)
+            asyncio.get_running_loop().call_later(self.busy_timeout, self.expire, waiter)
+
+        future = asyncio.wrap_future(waiter.future)
+        if kwargs.get('block', True):
+            return await future
+        return future
+
+    def expire(self, waiter):
+        """ As MachineConnection.expire """
+        if waiter.expire(self.internal_state, self.idle_event.is_set()):
+            self.waiters.remove(waiter)
+
+    def xyzu(self):
+        s = self.internal_state
+        return np.array([s['x'], s['y'], s['z'], s['u']], dtype = float)
+
+    def is_busy(self):
+        return self.busy_event.is_set()
+
+    snapshot = MachineConnection.snapshot
+    current_state = MachineConnection.current_state
+    changed_since = MachineConnection.changed_since
+    on_change = MachineConnection.on_change
+    remove_callback = MachineConnection.remove_callback
+
+    def value(self, key):
+        state = self.states.snapshot.state
+        return state[key] if key in state else self.internal_state[key]
+
+    def when(self, key, predicate = None):
+        """ As MachineConnection.when, but an asyncio future """
+        self.check()
+        return asyncio.wrap_future(self.watchers.when(key, predicate, lambda: self.value(key)))
+
+    async def wait_for(self, key, predicate = None, timeout = None):
+        """ As MachineConnection.wait_for """
+        return await asyncio.wait_for(self.when(key, predicate), timeout)
+
+    async def __aexit__(self, type, value, tb):
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        self.sub_writer.close()
+        self.writer.close()
@@ -1,9 +1,13 @@
 import cv2
 import numpy as np
-import thread_state
 import time
 import math
 
+from focus_metric import CMSLMetric
+from machine_interface import MachineConnection
+from frame_source import CaptureThread, OpenCVCamera
+from camera_cal import CameraCal
+
 def CMSL(img, window):
     """
         Contrast Measure based on squared Laplacian according to
@@ -62,68 +66,368 @@ def gss(f, a, b, tol=1e-5):
         return (c, b)
 
 
+def fit_peak(samples, base, model = 'gaussian'):
+    """ Weighted least squares fit of a peak model to a list of (z, score) samples.
+
+    gaussian: a parabola fit to log(score - base), weighted by (score - base)^2
+    so that samples near the background don't dominate (Guo's method)
+    parabola: a parabola fit directly to the scores
+
+    Returns the z of the peak, the standard error of that z (from the residuals
+    and the fit covariance, so infinite until there are at least five samples),
+    and the width of the peak - the Gaussian's sigma, or roughly the same for the
+    parabola. Returns None if there are too few samples or they aren't concave. """
+
+    z = np.array([p[0] for p in samples])
+    s = np.array([p[1] for p in samples])
+    if model == 'gaussian':
+        keep = s > base
+        z, s = z[keep], s[keep]
+        y, w = np.log(s - base), (s - base)**2
+    else:
+        y, w = s, np.ones(len(s))
+
+    n = len(z)
+    if n < 3:
+        return None
+    center = z.mean()
+    u = z - center
+    A = np.vstack([np.ones(n), u, u * u]).T
+    root_w = np.sqrt(w)
+    (c0, c1, c2), *_ = np.linalg.lstsq(A * root_w[:, None], y * root_w, rcond = None)
+    if c2 >= 0:
+        return None
+
+    peak = center - 0.5 * c1 / c2
+    if model == 'gaussian':
+        width = math.sqrt(-0.5 / c2)
+    else:
+        height = c0 - 0.25 * c1 * c1 / c2 - base
+        width = 0.7 * math.sqrt(max(height, 0) * 0.5 / -c2)
+
+    if n < 5:
+        # Too few degrees of freedom to trust the residuals as a noise estimate
+        return peak, math.inf, width
+
+    r = y - A @ np.array([c0, c1, c2])
+    variance = np.sum(w * r * r) / (n - 3)
+    cov = variance * np.linalg.pinv((A * w[:, None]).T @ A)
+    grad = np.array([0, -0.5 / c2, 0.5 * c1 / c2**2])
+    return peak, math.sqrt(max(grad @ cov @ grad, 0)), width
+
+
+def bracket_peak(samples, base, lo, hi):
+    """ Find the samples scoring above half of the peak height, relative to
+    base, in a list of (z, score) sorted by z. Returns the Zs of the nearest
+    samples either side of them (or lo/hi at the ends), and the samples
+    themselves. """
+
+    top = max(s for _, s in samples)
+    inner = [p for p in samples if p[1] >= base + 0.5 * (top - base)]
+    a = max([z for z, _ in samples if z < inner[0][0]], default = lo)
+    b = min([z for z, _ in samples if z > inner[-1][0]], default = hi)
+    return a, b, inner
+
+
+def bracketed_fit(samples, base, lo, hi, model = 'gaussian'):
+    """ Fit a peak model to the samples around the peak (see bracket_peak),
+    keeping the predicted peak inside the bracket. Returns the peak, its
+    standard error and width - or the best sample, an infinite error and no
+    width if the model can't be fit yet - then the bracket, and the samples
+    that were fitted. """
+
+    a, b, inner = bracket_peak(samples, base, lo, hi)
+    window = [p for p in samples if a <= p[0] <= b] if model == 'gaussian' else inner
+    fit = fit_peak(window, base, model)
+    if fit is None:
+        return (max(samples, key = lambda p: p[1])[0], math.inf, None), (a, b), window
+    z, err, width = fit
+    return (min(max(z, a), b), err, width), (a, b), window
+
+
+def peak_search(f, lo, hi, coarse = 7, tol = 0.05, max_evals = 15, model = 'gaussian'):
+    """ Coarse-to-fine search for the maximum of f over [lo, hi].
+
+    f is sampled at `coarse` evenly spaced points. The samples scoring above
+    half of the peak height (relative to the lowest score) and their nearest
+    neighbours either side bracket the peak, and a peak model is fit to the
+    samples in that bracket. Until there are enough samples for the fit to say
+    anything, the largest gap in the bracket is filled in; after that new
+    samples alternate either side of the predicted peak, about one peak width
+    out, where they constrain its position the most. The search stops once the
+    standard error of the predicted peak drops below tol, or after max_evals
+    evaluations of f.
+
+    The coarse spacing has to be finer than a few widths of the focus curve,
+    otherwise every coarse sample only sees the out of focus background.
+
+    Returns the peak estimate, its standard error, and all of the (z, score) samples. """
+
+    samples = [(z, f(z)) for z in np.linspace(lo, hi, coarse)]
+    spacing = (hi - lo) / (coarse - 1)
+    base = min(s for _, s in samples)
+    side = 1
+
+    while True:
+        samples.sort()
+        (z, err, width), (a, b), window = bracketed_fit(samples, base, lo, hi, model)
+
+        if err < tol or len(samples) >= max_evals:
+            return z, err, samples
+
+        if width is None or len(window) < 5:
+            zs = [a] + [p[0] for p in samples if a < p[0] < b] + [b]
+            g = max(range(len(zs) - 1), key = lambda j: zs[j + 1] - zs[j])
+            z = 0.5 * (zs[g] + zs[g + 1])
+        else:
+            z = min(max(z + side * min(width, spacing), lo), hi)
+            side = -side
+        samples.append((z, f(z)))
+
+
+def refined_peak_search(f, lo, hi, coarse = 7, tol = 0.05, fine = 5, max_evals = 15, **kwargs):
+    """ peak_search, repeated with `fine` coarse points over the samples either
+    side of the best one for as long as the peak isn't found to within tol -
+    so a focus curve too narrow for the first spacing to fit is still found.
+    (It does have to show up in the first round's samples at all.)
+
+    max_evals: evaluations of f allowed across every round. Each round gets
+      whatever's left, so the coarse grid should be well under it.
+
+    Returns as peak_search, with the samples from every round. """
+
+    everything, left = [], max_evals
+    n = min(coarse, max_evals)
+    while True:
+        z, err, samples = peak_search(f, lo, hi, n, tol, max_evals = left, **kwargs)
+        everything += samples
+        left -= len(samples)
+        if err < tol or left < 3:
+            break
+        samples.sort()
+        i = max(range(len(samples)), key = lambda j: samples[j][1])
+        lo, hi = samples[max(i - 1, 0)][0], samples[min(i + 1, len(samples) - 1)][0]
+        n = min(fine, left)
+    return z, err, sorted(everything)
+
+
+class FocusObjective:
+    """ Memoized focus objective for a machine and camera.
+
+    Calling it with a Z moves there, grabs a frame and returns its score, unless
+    that Z (to within `resolution`) has already been measured, in which case the
+    mean of the cached scores is returned without touching the machine. The
+    cache can be seeded with (z, score) samples from earlier sweeps.
+
+    Repeated frames at one Z cost a capture but not a move, and are pooled to
+    estimate the frame to frame noise of the metric. """
+
+    def __init__(self, machine, camera, metric = None, resolution = 0.005):
+        self.machine = machine
+        self.camera = camera
+        self.metric = CMSLMetric(10) if metric is None else metric
+        self.resolution = resolution
+        self.cache = {}
+        self.position = None
+        self.moves = 0
+        self.frames = 0
+
+    def key(self, z):
+        return round(z / self.resolution)
+
+    def seed(self, samples):
+        for z, score in samples:
+            self.cache.setdefault(self.key(z), []).append(score)
+
+    def measure(self, z, frames = 1):
+        """ Take more frames at z, regardless of what is cached """
+        k = self.key(z)
+        if self.position != k:
+            self.machine.move(Z = z)
+            self.position = k
+            self.moves += 1
+        scores = self.cache.setdefault(k, [])
+        for _ in range(frames):
+            ret, frame = self.camera.read()
+            scores.append(self.metric(frame))
+            self.frames += 1
+        return scores
+
+    def estimate(self, z, frames = 1):
+        """ Mean score at z over at least `frames` frames, and its standard
+        error (None until the noise has been estimated) """
+        scores = self.cache.get(self.key(z), [])
+        if len(scores) < frames:
+            scores = self.measure(z, frames - len(scores))
+        noise = self.noise()
+        return np.mean(scores), None if noise is None else noise / math.sqrt(len(scores))
+
+    def noise(self):
+        """ Pooled standard deviation of repeated scores at the same Z, or None
+        until there are enough repeats to say """
+        ss, dof = 0.0, 0
+        for scores in self.cache.values():
+            if len(scores) > 1:
+                ss += np.var(scores) * len(scores)
+                dof += len(scores) - 1
+        return math.sqrt(ss / dof) if dof >= 3 else None
+
+    def bracket(self):
+        """ The cached Zs either side of the best cached score """
+        zs = sorted(self.cache)
+        i = max(range(len(zs)), key = lambda j: np.mean(self.cache[zs[j]]))
+        lo, hi = zs[max(i - 1, 0)], zs[min(i + 1, len(zs) - 1)]
+        return lo * self.resolution, hi * self.resolution
+
+    def __call__(self, z):
+        return self.estimate(z)[0]
+
+
+def noisy_gss(f, a, b, tol = None, z_score = 2.0, max_frames = 8):
+    """ Golden section search for the maximum of a noisy FocusObjective.
+
+    Single frames are used while the two interior points are clearly different.
+    Once they're within z_score standard errors of each other, both are averaged
+    over more frames (doubling up to max_frames), and if they still can't be
+    told apart the search stops there rather than chasing noise. Returns the
+    final bracket, which is narrower than tol unless the search stopped on
+    noise, in which case it's the two indistinguishable points. tol defaults
+    to f's resolution, as anything finer only hits its cache. """
+
+    if tol is None:
+        tol = f.resolution
+    (a, b) = (min(a, b), max(a, b))
+    h = b - a
+    c = a + invphi2 * h
+    d = a + invphi * h
+
+    if f.noise() is None:
+        # We need a few repeats to know what the noise floor looks like
+        f.estimate(c, 4)
+
+    while h > tol:
+        n = 1
+        (yc, ec), (yd, ed) = f.estimate(c, n), f.estimate(d, n)
+        while abs(yc - yd) < z_score * math.hypot(ec, ed):
+            if n >= max_frames:
+                # Equal heights either side of a unimodal peak put it between them
+                return (c, d)
+            n *= 2
+            (yc, ec), (yd, ed) = f.estimate(c, n), f.estimate(d, n)
+
+        if yc > yd:
+            b = d
+            d = c
+            h = invphi * h
+            c = a + invphi2 * h
+        else:
+            a = c
+            c = d
+            h = invphi * h
+            d = a + invphi * h
+
+    return (a, b)
+
+
+def electric_slide(z_span, machine, camera, metric = None, feedrate = None, latency = 0.0, model = 'gaussian'):
+    """ Continuous motion focus sweep: one move from z_span[0] to z_span[1],
+    scoring frames for as long as the machine is moving.
 
+    Each frame is timestamped when it's read, less the camera's `latency`, and
+    its Z is interpolated from the streamed userPosition track, which we record
+    (with the time each new value arrives) from a change callback on z. A peak
+    model is then fit to the (z, score) pairs just as in peak_search, so the
+    result doesn't depend on the move's acceleration profile.
 
-def electric_slide(z_span, machine, camera):
+    feedrate: optional F for the sweep move - slower gives more frames per mm.
+      The feedrate from before is restored afterwards.
+
+    Returns the peak estimate, its standard error, and the (z, score) samples. """
+
+    if metric is None:
+        metric = CMSLMetric(10)
 
     from_z, to_z = z_span
-    m.gcode(f"""G0 Z{from_z}""", block = True)
+    machine.move(Z = from_z)
 
-    
-    ret, frame = cam.read()
-    best = CMSL(frame, 10).mean()
-    t_start = time.time()
-    best_t = t_start
-    
-    m.gcode(f"""G0 Z{to_z}""", block = False)
-    time.sleep(0.5)
-    while machine.is_busy():
-        
-        ret, frame = cam.read()
-        t = time.time()
-        score = CMSL(frame, 10).mean()
-        print(score)
-        if score > best:
-            best = score
-            best_t = t
-        
-    t_end = time.time()
-    interp = (best_t - t_start) / (t_end - t_start)
+    track_t, track_z = [time.time()], [machine.xyzu()[2]]
+    def record(key, z):
+        track_t.append(time.time())
+        track_z.append(z)
+
+    frames = []
+    machine.on_change('z', record)
+    if feedrate is None:
+        sweep = machine.move(Z = to_z, block = False)
+    else:
+        # F is modal, so save the feedrate (M120) and put it back (M121) once
+        # the sweep is queued, or every later move would crawl along at it
+        machine.gcode("M120", block = False)
+        sweep = machine.move(Z = to_z, F = feedrate, block = False)
+        machine.gcode("M121", block = False)
+
+    # Keep scoring frames until the move has settled
+    while not sweep.done():
+        ret, frame = camera.read()
+        frames.append((time.time() - latency, metric(frame)))
+    machine.remove_callback('z', record)
+
+    if not frames:
+        # The move was over before a frame was read (a very short sweep), so
+        # all there is to go on is one frame where it ended
+        ret, frame = camera.read()
+        frames.append((time.time() - latency, metric(frame)))
+
+    zs = np.interp([t for t, _ in frames], track_t, track_z)
+    samples = sorted(zip(zs, (s for _, s in frames)))
 
-    return (from_z + (to_z - from_z) * interp)
+    lo, hi = min(from_z, to_z), max(from_z, to_z)
+    base = min(s for _, s in samples)
+    (z, err, _), _, _ = bracketed_fit(samples, base, lo, hi, model)
+    return z, err, samples
 
 
-def oversampled_focus(zrange, steps, grid, center, machine, camera, scale = 2):
+def oversampled_focus(zrange, steps, grid, center, machine, camera, scale = 2, metric = None):
+
+    if metric is None:
+        metric = CMSLMetric(10)
 
     lo, hi = zrange
 
     for i in range(steps):
         z = lo + (hi - lo) * i / steps
-        m.gcode(f"""G0 Z{z}""")
+        machine.move(Z = z)
 
         for j in range(grid):
             x = (j / grid) * scale + center[0]
             
             for k in range(grid):
                 y = (k / grid) * scale + center[1]
-                m.gcode(f"""G0 X{x} Y{y}""")
-                ret, frame = cam.read()
-                score = CMSL(frame, 10).mean()
+                machine.move(X = x, Y = y)
+                ret, frame = camera.read()
+                score = metric(frame)
 
                 print(z, score)
 
 
-def linear_search(lo,hi,steps, machine, camera):
+def linear_search(lo,hi,steps, machine, camera, metric = None, samples = None):
+    """ Step through Z, returning the best Z and its score. If samples is a list,
+    every (z, score) is appended to it, e.g. to seed a FocusObjective. """
+
+    if metric is None:
+        metric = CMSLMetric(10)
 
     best = None
     best_z = None
     
     for z in np.linspace(lo,hi, steps):
         
-        m.gcode(f"""G0 Z{z}""")
-        ret, frame = cam.read()
-        score = CMSL(frame, 10).mean()
+        machine.move(Z = z)
+        ret, frame = camera.read()
+        score = metric(frame)
         print(z, score)
+        if samples is not None:
+            samples.append((z, score))
         if best is None or score > best:
             best = score
             best_z = z
@@ -131,28 +435,41 @@ def linear_search(lo,hi,steps, machine, camera):
     return best_z, best
 
 
-       
-print("Establishing camera connection")
-cam = cv2.VideoCapture(0)
+if __name__ == '__main__':
 
-with thread_state.MachineConnection('/var/run/dsf/dcs.sock') as m:
-    
-    def objective(z):
-        
-        m.gcode(f"""G0 Z{z}""")
-        ret, frame = cam.read()
-        return CMSL(frame, 10).mean()
+    print("Establishing camera connection")
+    camera = OpenCVCamera(0)
 
-    best_z, _ = linear_search(20, 200, 100, m, cam)
-    print("Second search")
-    best_z, _ = linear_search(best_z - 20,best_z, 100, m, cam)
+    metric = CMSLMetric(10)
 
-    print("Final tuning")
-    a,b = gss(objective, best_z- 2, best_z + 2 , 0.05)
+    with MachineConnection('/var/run/dsf/dcs.sock') as m, \
+         CaptureThread(camera, machine = m) as cam:
 
-    print(0.5 * (a + b))
-    print(objective(0.5 * (a + b)))
-    
-    #oversampled_focus((z - 0.25, 56.97900690713337 + 0.25), 20, 5, (150, 150), m, cam)
-    
-cam.release()
+        objective = FocusObjective(m, cam, metric)
+        tol = 0.05
+
+        # The fast path: focus is normally within a few mm of the calibration's
+        # bed focus, and a 7 point grid over 20mm there, then finer rounds over
+        # the bracket, finds it in under 15 moves
+        cal = CameraCal.load("camera_cal.json")
+        err = math.inf
+        if cal.bed_focus is not None:
+            z, err, samples = refined_peak_search(objective, cal.bed_focus - 10, cal.bed_focus + 10,
+                                                  coarse = 7, tol = tol, max_evals = 15)
+
+        if err >= tol:
+            # The slow path over the whole range: 6mm between coarse samples,
+            # which a focus curve down to 1mm wide still shows up in. Anything
+            # measured already is cached, so costs no moves.
+            print(f"""Focus not near the bed focus after {objective.moves} moves, searching from Z20 to Z200""")
+            z, err, samples = refined_peak_search(objective, 20, 200, coarse = 31, tol = tol, max_evals = 60)
+
+        if err >= tol:
+            print(f"""Focus not found to within {tol}: best guess Z{z} +/- {err} after {objective.moves} moves""")
+        else:
+            print(f"""Best focus at Z{z} +/- {err} after {objective.moves} moves""")
+        print(objective(z))
+
+        #oversampled_focus((z - 0.25, 56.97900690713337 + 0.25), 20, 5, (150, 150), m, cam)
+
+    camera.close()
@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+import os
+import json
+import sys
+import time
+
+from focus_metric import metrics, make_metric
+
+
+def load_stack(directory):
+    """ Load a Z-stack in the layout written by grab_frame.py: a meta.json whose
+    'photos' maps frame numbers to [x, y, z], and a <number>.png per frame.
+    Returns the z values (sorted) and the matching list of frames. """
+
+    with open(os.path.join(directory, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    stack = []
+    for key, (x, y, z) in meta['photos'].items():
+        stack.append((z, cv2.imread(os.path.join(directory, str(key) + ".png"))))
+    stack.sort(key = lambda s: s[0])
+
+    return np.array([z for z, _ in stack]), [frame for _, frame in stack]
+
+
+def time_metric(metric, frames, repeats = 3):
+    """ Score every frame, returning the scores and the median cost in microseconds """
+    scores = np.empty(len(frames))
+    costs = []
+    metric(frames[0]) # Allocate scratch space outside of the timing
+
+    for _ in range(repeats):
+        for i, frame in enumerate(frames):
+            t = time.perf_counter()
+            scores[i] = metric(frame)
+            costs.append(time.perf_counter() - t)
+
+    return scores, 1e6 * np.median(costs)
+
+
+def curve_shape(z, scores):
+    """ Summarize a focus curve as (peak z, full width at half maximum, unimodality).
+
+    The width is measured in z around the peak on the curve normalized to [0,1],
+    so narrower is sharper. Unimodality is the fraction of the curve's total
+    variation that goes the right way - up before the peak, down after it - so a
+    perfectly unimodal curve scores 1. """
+
+    lo, hi = scores.min(), scores.max()
+    if hi == lo:
+        return z[0], z[-1] - z[0], 0.0
+    c = (scores - lo) / (hi - lo)
+    peak = np.argmax(c)
+
+    def crossing(inside, outside):
+        # Linearly interpolate where the curve passes through half maximum
+        t = (c[inside] - 0.5) / (c[inside] - c[outside])
+        return z[inside] + t * (z[outside] - z[inside])
+
+    left = peak
+    while left > 0 and c[left - 1] >= 0.5:
+        left -= 1
+    right = peak
+    while right < len(c) - 1 and c[right + 1] >= 0.5:
+        right += 1
+    zl = crossing(left, left - 1) if left > 0 else z[0]
+    zr = crossing(right, right + 1) if right < len(c) - 1 else z[-1]
+
+    steps = np.diff(c)
+    wrong = np.sum(np.clip(-steps[:peak], 0, None)) + np.sum(np.clip(steps[peak:], 0, None))
+    total = np.sum(np.abs(steps))
+
+    return z[peak], zr - zl, 1 - wrong / total
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: benchmark_focus.py <z-stack directory> [repeats]")
+        exit()
+
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    z, frames = load_stack(sys.argv[1])
+    print(f"""Loaded {len(frames)} frames from Z {z[0]} to {z[-1]}""")
+
+    print(f"""{'metric':>12} {'us/frame':>10} {'peak z':>10} {'fwhm':>8} {'unimodal':>9}""")
+    for name in metrics:
+        scores, cost = time_metric(make_metric(name), frames, repeats)
+        peak, width, unimodal = curve_shape(z, scores)
+        print(f"""{name:>12} {cost:10.0f} {peak:10.3f} {width:8.3f} {unimodal:9.3f}""")
@@ -0,0 +1,80 @@
+import socket
+import json
+import sys
+import time
+import numpy as np
+
+from machine_interface import (BlobReader, CompiledTemplate, internal_paths, internal_template,
+                               keys_in_template, partial_update, sendblob)
+
+# Per-patch cost of applying object model patches to tracked state, walking the
+# template against every patch (partial_update) versus a CompiledTemplate. Patch streams
+# are recorded from a live (or simulated) DSF socket as one JSON document per line.
+
+# Roughly what the picking and orienting scripts want to know about
+example_template = {'state': {'status': 'status', 'upTime': 'uptime'},
+                    'move': {'axes': {0: {'userPosition': 'x', 'machinePosition': 'mx'},
+                                      1: {'userPosition': 'y', 'machinePosition': 'my'},
+                                      2: {'userPosition': 'z', 'machinePosition': 'mz'},
+                                      3: {'userPosition': 'u', 'machinePosition': 'mu'}},
+                             'currentMove': 'current_move'},
+                    'heat': {'heaters': {0: {'current': 'bed'}, 1: {'current': 'tool'}}},
+                    'tools': 'tools'}
+
+
+def record(socket_addr, n):
+    """ Subscribe to a DSF socket, returning the full state and the next n patches """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_addr)
+    reader = BlobReader(sock)
+    sendblob(sock, {"mode":"subscribe","version": 8, "subscriptionMode": "Patch"})
+    reader.ignore()
+    reader.ignore()
+    messages = [reader.get()]
+    for _ in range(n):
+        sendblob(sock, {"command" : "Acknowledge"})
+        messages.append(reader.get())
+    sock.close()
+    return messages
+
+
+def time_updates(apply, messages, repeats):
+    """ Median cost of applying every message in turn, in microseconds per message """
+    costs = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        for message in messages:
+            apply(message)
+        costs.append((time.perf_counter() - t) / len(messages))
+    return 1e6 * np.median(costs)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: benchmark_patches.py <patch stream> [repeats]")
+        print("       benchmark_patches.py record <socket path> <patch stream> <number of patches>")
+        exit()
+
+    if sys.argv[1] == 'record':
+        messages = record(sys.argv[2], int(sys.argv[4]))
+        with open(sys.argv[3], "w") as f:
+            for message in messages:
+                f.write(json.dumps(message) + "\n")
+        print(f"""Recorded {len(messages) - 1} patches""")
+        exit()
+
+    with open(sys.argv[1], "r") as f:
+        messages = [json.loads(line) for line in f]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"""Loaded {len(messages) - 1} patches""")
+
+    for name, template in [('internal', internal_template), ('example', example_template)]:
+        state = {k: {} for k in keys_in_template(template)}
+        walked = time_updates(lambda message: partial_update(state, template, message), messages, repeats)
+
+        compiled = internal_paths if template is internal_template else CompiledTemplate(template)
+        state = {k: {} for k in compiled.keys}
+        flat = time_updates(lambda message: compiled.apply(state, message), messages, repeats)
+
+        print(f"""{name:>10} template: {walked:6.2f} us/patch walked, {flat:6.2f} us/patch compiled""")
@@ -1,13 +1,14 @@
 import numpy as np
-import time
 import math
 import random
 import sys
 import json
-import picamera
 
 import cv2
 from machine_interface import MachineConnection
+from frame_source import CaptureThread, PiCamera
+from camera_cal import basis
+from circle_finder import CircleFinder
 
 
 
@@ -15,19 +16,16 @@ from machine_interface import MachineConnection
 
 
 
-def find_single_point(frame,gain = 3.0):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    pix = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, gain, minDist = 100)
+# The calibration target is the only circle in view, of a size we don't know yet
+single_point = CircleFinder(0, 0, 100, gain = 3.0, threshold = 100)
 
-    if pix is None:
-        return None
+def find_single_point(frame):
+    found = single_point(frame)
 
-    pix = pix[0,:]
-    
-    if pix.shape[0] != 1:
+    if found.shape[0] != 1:
         return None
 
-    x,y = pix[0,0:2]
+    x,y = found['center'][0]
     size = frame.shape
     
     return (x / size[1]) - 0.5, (y / size[0]) - 0.5
@@ -44,16 +42,27 @@ def least_square_mapping(calibration_points):
         real_coords[i] = r
         pixel_coords[i] = p
         
-    x,y = pixel_coords[:,0],pixel_coords[:,1]
-    A = np.vstack([x**2,y**2,x * y, x,y,np.ones(n)]).T
+    A = np.hstack([basis(pixel_coords), np.ones((n,1))])
     transform = np.linalg.lstsq(A, real_coords, rcond = None)
     return transform[0], transform[1].mean()
 
-def frame_getter(resolution, camera):
+def inverse_mapping(calibration_points, transform):
+    """ Fit the map back from real space, as offsets from the position the
+    forward transform puts at the center of the frame, to pixels - for
+    camera_cal.CameraCal.real_to_px """
+    real_coords = np.array([r for r,p in calibration_points], dtype = float) - transform[-1]
+    pixel_coords = np.array([p for r,p in calibration_points], dtype = float)
+    A = np.hstack([basis(real_coords), np.ones((len(real_coords),1))])
+    return np.linalg.lstsq(A, pixel_coords, rcond = None)[0]
+
+def frame_getter(source):
+    """ Returns a function giving the first frame captured once the machine is
+    idle, transposed. Every call reuses the same output array. """
+
+    output = np.empty(source.frames.shape[1:], dtype = np.uint8)
 
     def ret():
-        output = np.empty((resolution[1], resolution[0], 3), dtype=np.uint8)
-        camera.capture(output, 'rgb', use_video_port = True)
+        source.after_idle(out = output)
         return np.transpose(output, axes = (1,0,2))
 
     return ret
@@ -74,7 +83,7 @@ def collect_random_points(center, radius, evaluate_location, points = 10):
 def collect_grid_points(transform, evaluate, border = 0.1, n = 5):
     for x in np.linspace(border - 0.5, 1 - border - 0.5, n):
         for y in np.linspace(border - 0.5 , 1 - border -0.5, n):
-            v = np.array([x**2, y **2, x * y, x, y, 1.0])
+            v = np.append(basis(np.array([[x, y]]))[0], 1.0)
             target = transform.T @ v
             pxy = evaluate(target)
 
@@ -105,68 +114,69 @@ if __name__ == '__main__':
     print("Establishing machine connection...")
     with MachineConnection('/var/run/dsf/dcs.sock') as m:
 
-        with picamera.PiCamera() as camera:
-    
-            camera.resolution = (1648,1232)
-            camera.framerate = 24
-            time.sleep(2)
+        resolution = (1648,1232)
+        with PiCamera(resolution) as camera:
+
             print("...camera connection established")
 
-            frames = frame_getter(camera.resolution, camera)
+            with CaptureThread(camera, machine = m) as source:
+
+                frames = frame_getter(source)
         
-            print("Moving to focus")
-            m.move(Z = focus_height)
+                print("Moving to focus")
+                m.move(Z = focus_height)
         
-            radius = 10
-            points = 20
-            position = m.current_state()
+                radius = 10
+                points = 20
+                position = m.current_state()
 
-            xy = m.xyzu()[0:2]
+                xy = m.xyzu()[0:2]
 
 
-            def evaluate_at_point(p):
-                m.move(p, F= 10000)
-                return find_single_point(frames())
+                def evaluate_at_point(p):
+                    m.move(p, F= 10000)
+                    return find_single_point(frames())
 
-            print("Begining rough pass")
-            results = list(collect_random_points(xy, 10, evaluate_at_point))
+                print("Begining rough pass")
+                results = list(collect_random_points(xy, 10, evaluate_at_point))
 
-            if len(results) < 5:
-                print("Too many failures")
-                exit()
+                if len(results) < 5:
+                    print("Too many failures")
+                    exit()
             
 
-            transform, residual = least_square_mapping(results)
+                transform, residual = least_square_mapping(results)
 
-            print("Begining fine pass")
-            results += list(collect_grid_points(transform, evaluate_at_point))
+                print("Begining fine pass")
+                results += list(collect_grid_points(transform, evaluate_at_point))
 
-            frame = frames()
-            transform, residual = least_square_mapping(results)
+                frame = frames()
+                transform, residual = least_square_mapping(results)
             
-            linear_part = transform[:-1,:]
-            _,sigma,_ = np.linalg.svd(linear_part[-2:,:] @ np.diag([1 / frame.shape[0], 1 / frame.shape[1]]))
+                linear_part = transform[:-1,:]
+                _,sigma,_ = np.linalg.svd(linear_part[-2:,:] @ np.diag([1 / frame.shape[0], 1 / frame.shape[1]]))
             
             
-            # Write out the calibration data
-            cal = {'bed_focus' : focus_height,
-                   'transform' : transform[:-1,:].tolist(),
-                   'resolution' : camera.resolution,
-                   'scale': [min(sigma),max(sigma)]}
-            with open("camera_cal.json","w") as j:
-                json.dump(cal, j)
-
-            print("Calibration file writen to camera_cal.json")
-             # Now move the centroid of the dot to the center of the screen,
-            # take a snap, and write that out as a human-checkable certificate
-            point = transform.T @ np.array([0, 0, 0, 0, 0, 1])
+                # Write out the calibration data
+                cal = {'bed_focus' : focus_height,
+                       'transform' : transform[:-1,:].tolist(),
+                       'resolution' : resolution,
+                       'scale': [min(sigma),max(sigma)],
+                       'inverse' : inverse_mapping(results, transform).tolist()}
+                with open("camera_cal.json","w") as j:
+                    json.dump(cal, j)
+
+                print("Calibration file writen to camera_cal.json")
+                 # Now move the centroid of the dot to the center of the screen,
+                # take a snap, and write that out as a human-checkable certificate
+                point = transform.T @ np.array([0, 0, 0, 0, 0, 1])
             
-            m.move(point)
-            frame = frames()
-            decorate_image(frame)
-            fp = "cal_certificate.png"
-            print("Check image written to " + fp)
-            cv2.imwrite(fp,frame)
+                m.move(point)
+                frame = frames()
+                decorate_image(frame)
+                fp = "cal_certificate.png"
+                print("Check image written to " + fp)
+                cv2.imwrite(fp,frame)
             
-            m.move(xy)
+                m.move(xy)
 
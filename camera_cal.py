@@ -0,0 +1,128 @@
+import json
+import numpy as np
+
+# The camera calibration written by calibrate_camera.py (camera_cal.json) maps
+# pixel positions in a frame to real space offsets from the machine position,
+# with a quadratic in the pixel coordinates. Those are normalized to [-0.5, 0.5]
+# across the frame - x by the number of columns, y by the number of rows -
+# and the calibration's 'resolution' is the (rows, columns) of the frames it
+# was made from. Newer calibrations also fit the quadratic the other way round,
+# as 'inverse', which gives real_to_px a close first guess.
+
+
+def basis(xy):
+    """ The quadratic basis [x^2, y^2, xy, x, y] for an N x 2 array of normalized
+    pixel coordinates, as an N x 5 array """
+    x, y = xy[:, 0], xy[:, 1]
+    return np.stack([x * x, y * y, x * y, x, y], axis = 1)
+
+
+class CameraCal:
+    """ A loaded calibration. Every conversion takes and returns N x 2 arrays,
+    or a single point as a pair.
+
+    bed_focus: Z height at which the bed is in focus
+    matrix: the 5 x 2 quadratic map from basis(normalized pixels) to real space
+    inverse: the fitted 6 x 2 map from basis(real space) and a constant back to
+      normalized pixels, or None for calibrations from before it was added
+    scale: smallest and largest mm per pixel across the frame """
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.matrix = np.array(self.blob['transform'], dtype = float)
+        self.size = self.blob['resolution']
+        self.scale = self.blob['scale']
+        self.bed_focus = self.blob.get('bed_focus')
+        self.inverse = np.array(self.blob['inverse'], dtype = float) if 'inverse' in self.blob else None
+
+        # The linear part, for a first guess at the inverse map without a fitted one
+        self.linear = self.matrix[3:5]
+        self.linear_inverse = np.linalg.inv(self.linear)
+
+    @classmethod
+    def load(cls, path = "camera_cal.json"):
+        """ Load a calibration file, once - later loads of the same path share it """
+        if path not in loaded:
+            with open(path, "r") as f:
+                loaded[path] = cls(json.load(f))
+        return loaded[path]
+
+    def frame_size(self, shape):
+        """ (columns, rows) for frames of the given shape, or of the calibration's own frames """
+        if shape is None:
+            return np.array([self.size[1], self.size[0]], dtype = float)
+        return np.array([shape[1], shape[0]], dtype = float)
+
+    def pixel_scale(self, shape = None):
+        """ Smallest and largest mm per pixel across frames of the given shape,
+        which have fewer (or more) pixels to the mm than the calibration's own """
+        factor = self.frame_size(None) / self.frame_size(shape)
+        return self.scale[0] * factor.min(), self.scale[1] * factor.max()
+
+    def px_to_real(self, x, y = None, shape = None):
+        """ Real space offsets from the machine position of pixel positions, given
+        as an N x 2 array of (x, y), or as a single x and y.
+
+        shape: shape of the frame the pixels are in, if it isn't the calibration's """
+        single = y is not None
+        px = np.array([[x, y]], dtype = float) if single else np.asarray(x, dtype = float).reshape(-1, 2)
+        real = basis(px / self.frame_size(shape) - 0.5) @ self.matrix
+        return real[0] if single else real
+
+    def real_to_px(self, real, shape = None, iterations = None):
+        """ Pixel positions of real space offsets from the machine position (an
+        N x 2 array, or a single pair), inverting px_to_real by Newton's method.
+        That starts from the fitted inverse if there is one, and needs just a
+        couple of iterations, or from the linear part's inverse otherwise. """
+        real = np.asarray(real, dtype = float)
+        single = real.ndim == 1
+        real = real.reshape(-1, 2)
+
+        q = self.matrix
+        if self.inverse is not None:
+            p = basis(real) @ self.inverse[:5] + self.inverse[5]
+        else:
+            p = real @ self.linear_inverse
+        if iterations is None:
+            iterations = 2 if self.inverse is not None else 5
+        for _ in range(iterations):
+            x, y = p[:, 0:1], p[:, 1:2]
+            residual = basis(p) @ q - real
+            # Rows of the Jacobian of the map at each point
+            dx = 2 * x * q[0] + y * q[2] + q[3]
+            dy = 2 * y * q[1] + x * q[2] + q[4]
+            det = dx[:, 0] * dy[:, 1] - dx[:, 1] * dy[:, 0]
+            p = p - np.stack([(residual[:, 0] * dy[:, 1] - residual[:, 1] * dy[:, 0]) / det,
+                              (dx[:, 0] * residual[:, 1] - dx[:, 1] * residual[:, 0]) / det], axis = 1)
+
+        px = (p + 0.5) * self.frame_size(shape)
+        return px[0] if single else px
+
+    def roi(self, box, shape = None, margin = 0):
+        """ The pixel region of interest (x, y, width, height) - as taken by
+        focus_metric and the circle finders - covering a real space box
+        (x0, y0, x1, y1) of offsets from the machine position, widened by margin
+        pixels and clipped to the frame. None if it's entirely out of frame. """
+        x0, y0, x1, y1 = box
+        # The map is quadratic, so edges can bow outwards - sample along them
+        t = np.linspace(0, 1, 5)
+        xs, ys = x0 + t * (x1 - x0), y0 + t * (y1 - y0)
+        edges = np.concatenate([np.stack([xs, np.full(5, y0)], axis = 1), np.stack([xs, np.full(5, y1)], axis = 1),
+                                np.stack([np.full(5, x0), ys], axis = 1), np.stack([np.full(5, x1), ys], axis = 1)])
+        px = self.real_to_px(edges, shape)
+
+        columns, rows = self.frame_size(shape)
+        left, top = np.floor(px.min(axis = 0)) - margin
+        right, bottom = np.ceil(px.max(axis = 0)) + margin
+        left, top = max(int(left), 0), max(int(top), 0)
+        right, bottom = min(int(right), int(columns)), min(int(bottom), int(rows))
+        if right <= left or bottom <= top:
+            return None
+        return left, top, right - left, bottom - top
+
+    def distance_to_px_range(self, distance, slop = 0.1):
+        return int((1 - slop) * distance / self.scale[1]), int((1 + slop) * distance / self.scale[0])
+
+
+# Calibrations loaded from files, by path
+loaded = {}
@@ -0,0 +1,217 @@
+import sys
+import time
+import cv2
+import numpy as np
+
+# Circle detection for wells, fiducials and calibration targets. A Hough
+# transform over the whole full resolution frame is by far the slowest part of
+# orienting a plate, so circles are found on a downscaled pyramid level, where
+# there are a fraction of the pixels to vote with, and then each one is refined
+# on the full resolution frame: the intensity is sampled along rays out from
+# the rough center, the edge is located to sub-pixel accuracy on each ray, and
+# a circle is fitted through the edge points. Only those few thousand samples
+# touch the full resolution frame.
+#
+# For the wells of a plate filling a 1648 x 1232 frame that's about twice as
+# fast as a full resolution Hough transform (run this file to compare), with
+# most of what's left in the refinement - so the real savings come from only
+# searching a region of interest where one's known.
+
+circle_dtype = np.dtype([('center', np.float64, 2), ('radius', np.float64), ('confidence', np.float64)])
+
+
+def to_gray(frame):
+    if frame.ndim == 3:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+def sample(gray, x, y):
+    """ Bilinearly interpolated values of an image at arrays of x and y, with
+    points off the edge taking the nearest edge value. x and y must be float32. """
+    shape = x.shape
+    values = cv2.remap(gray, x.reshape(-1, shape[-1]), y.reshape(-1, shape[-1]), cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+    return values.astype(np.float32).reshape(shape)
+
+
+def fit_circles(x, y, weights):
+    """ Weighted least squares circle fits (Kasa's method) through each row of
+    the points x, y. Returns the centers and radii. """
+    # x^2 + y^2 = 2 a x + 2 b y + c, for center (a, b) and radius^2 = c + a^2 + b^2,
+    # solved about each row's mean point for conditioning
+    w = weights / np.maximum(weights.sum(axis = 1, keepdims = True), 1e-12)
+    mx, my = (w * x).sum(axis = 1, keepdims = True), (w * y).sum(axis = 1, keepdims = True)
+    u, v = x - mx, y - my
+    wu, wv = w * u, w * v
+    suu, suv, svv = (wu * u).sum(axis = 1), (wu * v).sum(axis = 1), (wv * v).sum(axis = 1)
+    rr = u * u + v * v
+    ru, rv = 0.5 * (wu * rr).sum(axis = 1), 0.5 * (wv * rr).sum(axis = 1)
+    # About the mean the constant term drops out, leaving a 2 x 2 system
+    det = suu * svv - suv * suv
+    det = np.where(np.abs(det) > 1e-12, det, 1e-12)
+    a = (ru * svv - rv * suv) / det
+    b = (rv * suu - ru * suv) / det
+    radius = np.sqrt(a * a + b * b + (w * rr).sum(axis = 1))
+    return np.stack([a + mx[:, 0], b + my[:, 0]], axis = 1), radius
+
+
+class CircleFinder:
+    """ Finds circles of a known size range in frames.
+
+    min_radius, max_radius: radius range in full resolution pixels, 0 for
+      unknown as with cv2.HoughCircles
+    min_distance: smallest distance between circle centers, in pixels
+    levels: number of times to halve the frame before the Hough transform.
+      By default, as many as keep min_radius at least level_radius pixels.
+    gain: inverse accumulator resolution (HoughCircles' dp) at that level
+    threshold: accumulator votes needed at that level (HoughCircles' param2)
+    rays, tolerance: number of rays cast to refine each circle, and how far (in
+      pixels) an edge point can be off the fitted circle and still count
+    roi: optional default (x, y, width, height) pixel region to search """
+
+    def __init__(self, min_radius, max_radius, min_distance, levels = None, gain = 1.5, threshold = 20,
+                 rays = 24, tolerance = 1.0, roi = None, level_radius = 4):
+        self.min_radius, self.max_radius = min_radius, max_radius
+        self.min_distance = min_distance
+        if levels is None:
+            levels = 0
+            while min_radius / 2**(levels + 1) >= level_radius:
+                levels += 1
+        self.levels = levels
+        self.gain, self.threshold = gain, threshold
+        self.tolerance = tolerance
+        self.roi = roi
+
+        angles = np.linspace(0, 2 * np.pi, rays, endpoint = False)
+        self.directions = np.stack([np.cos(angles), np.sin(angles)], axis = 1).astype(np.float32)
+        # Where along each ray to look for the edge, as fractions of the rough radius
+        self.steps = np.linspace(0.7, 1.3, 25, dtype = np.float32)
+
+    def coarse(self, gray):
+        """ Rough centers and radii, in the pixels of gray, from a Hough transform
+        on its downscaled pyramid level """
+        small = gray
+        for _ in range(self.levels):
+            small = cv2.pyrDown(small)
+        f = 2**self.levels
+        circles = cv2.HoughCircles(small, cv2.HOUGH_GRADIENT, self.gain,
+                                   minDist = max(self.min_distance / f, 1),
+                                   param2 = self.threshold,
+                                   minRadius = int(self.min_radius / f),
+                                   maxRadius = int(np.ceil(self.max_radius / f)))
+        if circles is None:
+            return np.empty((0, 2)), np.empty(0)
+        circles = circles[0].astype(np.float64)
+        # pyrDown pixel centers sit at the middle of 2 x 2 blocks
+        return (circles[:, 0:2] + 0.5) * f - 0.5, circles[:, 2] * f
+
+    def refine(self, gray, centers, radii):
+        """ Sub-pixel circles from rough ones: the strongest radial intensity
+        step along each ray, interpolated between samples, is taken as an edge
+        point, and a circle fitted to the edge points - twice, the second time
+        leaving out points off the first circle. Returns circle_dtype records. """
+        n, d = len(centers), self.directions
+        found = np.zeros(n, dtype = circle_dtype)
+        if n == 0:
+            return found
+
+        # Sample points: circle x ray x step
+        c, rough = centers.astype(np.float32), radii.astype(np.float32)
+        r = rough[:, None, None] * self.steps[None, None, :]
+        x = c[:, 0, None, None] + r * d[None, :, 0, None]
+        y = c[:, 1, None, None] + r * d[None, :, 1, None]
+        profile = sample(gray, x, y)
+
+        # Strongest step of either sign, placed by fitting a parabola through it and its neighbours
+        step = np.abs(np.diff(profile, axis = 2))
+        k = np.clip(np.argmax(step, axis = 2), 1, step.shape[2] - 2)
+        left, mid, right = (np.take_along_axis(step, (k + o)[:, :, None], axis = 2)[:, :, 0] for o in (-1, 0, 1))
+        curvature = left - 2 * mid + right
+        shift = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, -1), 0)
+        along = self.steps[0] + (k + 0.5 + np.clip(shift, -0.5, 0.5)) * (self.steps[1] - self.steps[0])
+        ex = centers[:, 0, None] + radii[:, None] * along * d[None, :, 0]
+        ey = centers[:, 1, None] + radii[:, None] * along * d[None, :, 1]
+
+        weights = np.ones_like(ex)
+        for _ in range(2):
+            fitted, fitted_r = fit_circles(ex, ey, weights)
+            off = np.abs(np.hypot(ex - fitted[:, 0, None], ey - fitted[:, 1, None]) - fitted_r[:, None])
+            weights = (off <= self.tolerance).astype(np.float64)
+            enough = weights.sum(axis = 1) >= 3
+            weights[~enough] = 1
+
+        # Keep the rough circle for anything the fit has wandered away from
+        moved = np.hypot(*(fitted - centers).T)
+        good = enough & (moved < 0.5 * radii) & (np.abs(fitted_r - radii) < 0.5 * radii)
+        found['center'] = np.where(good[:, None], fitted, centers)
+        found['radius'] = np.where(good, fitted_r, radii)
+        found['confidence'] = np.where(good, weights.mean(axis = 1), 0)
+        return found
+
+    def __call__(self, frame, roi = None, refine = True):
+        """ Every circle in a frame (or in the roi, or the finder's default roi),
+        as a circle_dtype array of full frame pixel centers, radii, and the
+        fraction of edge points agreeing with each (0 where refinement failed,
+        or wasn't asked for) """
+        roi = self.roi if roi is None else roi
+        ox, oy = 0, 0
+        if roi is not None:
+            ox, oy, w, h = roi
+            frame = frame[oy:oy + h, ox:ox + w]
+        gray = to_gray(frame)
+
+        centers, radii = self.coarse(gray)
+        if refine:
+            found = self.refine(gray, centers, radii)
+        else:
+            found = np.zeros(len(centers), dtype = circle_dtype)
+            found['center'], found['radius'] = centers, radii
+        found['center'] += (ox, oy)
+        return found
+
+
+if __name__ == '__main__':
+
+    # Time the finder against a full resolution Hough transform, on a saved
+    # frame or a synthetic one of wells at a known 0.0556 mm per pixel
+    if len(sys.argv) > 1:
+        frame = cv2.imread(sys.argv[1])
+        truth = None
+    else:
+        rng = np.random.default_rng(0)
+        frame = np.full((1232, 1648, 3), 200, dtype = np.uint8)
+        truth = []
+        for i in range(-8, 9):
+            for j in range(-6, 7):
+                c = np.array([824 + 81 * i + 0.37 * j, 616 + 81 * j - 0.37 * i]) + rng.uniform(-0.5, 0.5, 2)
+                if np.all(c > 30) and c[0] < 1618 and c[1] < 1202:
+                    truth.append(c)
+                    cv2.circle(frame, (int(c[0] * 16), int(c[1] * 16)), int(22.5 * 16), (60, 60, 60), -1,
+                               cv2.LINE_AA, shift = 4)
+        truth = np.array(truth)
+        frame = cv2.GaussianBlur(frame, (5, 5), 1.0)
+        frame = np.clip(frame + rng.normal(0, 4, frame.shape), 0, 255).astype(np.uint8)
+
+    finder = CircleFinder(18, 27, 65)
+    gray = to_gray(frame)
+
+    def best_of(f, n = 5):
+        times = []
+        for _ in range(n):
+            t = time.perf_counter()
+            result = f()
+            times.append(time.perf_counter() - t)
+        return result, min(times)
+
+    full, full_time = best_of(lambda: cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 2.2, minDist = 65,
+                                                       minRadius = 18, maxRadius = 27))
+    found, time_taken = best_of(lambda: finder(frame))
+    full = np.empty((0, 2)) if full is None else full[0][:, 0:2]
+
+    print(f"""full resolution Hough: {len(full)} circles in {1e3 * full_time:.1f} ms""")
+    print(f"""CircleFinder ({finder.levels} levels): {len(found)} circles in {1e3 * time_taken:.1f} ms""")
+    if truth is not None:
+        for name, centers in [("full resolution Hough", full), ("CircleFinder", found['center'])]:
+            if len(centers):
+                error = np.sqrt(np.min(np.sum((centers[:, None] - truth[None])**2, axis = 2), axis = 1))
+                print(f"""{name}: {len(truth)} wells, median error {np.median(error):.2f} px, worst {error.max():.2f} px""")
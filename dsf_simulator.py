@@ -0,0 +1,279 @@
+import threading
+import socketserver
+import time
+import math
+import os
+import sys
+import numpy as np
+
+from machine_interface import BlobReader, MachineConnection, sendblob
+
+# A stand-in for the Duet Software Framework control server socket, close enough
+# to drive MachineConnection without a Duet: the same connection handshake, the
+# same subscribe/Patch protocol, and SimpleCode commands that move simulated axes.
+
+axis_letters = ['X', 'Y', 'Z', 'U']
+
+
+def read_messages(sock):
+    """ Generator of JSON messages from a socket, ending when it's closed """
+    reader = BlobReader(sock)
+    while True:
+        try:
+            yield reader.get()
+        except ConnectionError:
+            return
+
+
+def diff(old, new):
+    """ The patch that turns old into new, in the form DSF sends: changed dict
+    keys only, and lists patched element-wise with {} for unchanged elements.
+    Returns None if nothing changed. """
+    if isinstance(new, dict) and isinstance(old, dict):
+        patch = {}
+        for k, v in new.items():
+            d = diff(old.get(k), v) if k in old else v
+            if d is not None:
+                patch[k] = d
+        return patch or None
+    if isinstance(new, list) and isinstance(old, list) and len(new) == len(old):
+        patch = [diff(o, n) for o, n in zip(old, new)]
+        if all(p is None for p in patch):
+            return None
+        return [{} if p is None else p for p in patch]
+    return None if new == old else new
+
+
+class Move:
+    """ One straight line move with a trapezoidal (or, if it's too short to
+    reach full speed, triangular) velocity profile """
+
+    def __init__(self, t0, start, end, feedrate, acceleration):
+        self.t0, self.start, self.end = t0, start, end
+        delta = end - start
+        self.distance = math.sqrt(delta.dot(delta))
+        self.direction = delta / self.distance if self.distance > 0 else delta
+        self.acceleration = acceleration
+
+        v = feedrate / 60
+        if v * v / acceleration > self.distance:
+            v = math.sqrt(self.distance * acceleration)
+        self.velocity = v
+        self.t_accel = v / acceleration if v > 0 else 0
+        self.d_accel = 0.5 * v * self.t_accel
+        cruise = (self.distance - 2 * self.d_accel) / v if v > 0 else 0
+        self.t1 = t0 + self.t_accel + cruise
+        self.t_end = self.t1 + self.t_accel
+
+    def position(self, t):
+        if t >= self.t_end:
+            return self.end
+        tau = t - self.t0
+        if tau <= self.t_accel:
+            s = 0.5 * self.acceleration * tau * tau
+        elif t <= self.t1:
+            s = self.d_accel + self.velocity * (tau - self.t_accel)
+        else:
+            left = self.t_end - t
+            s = self.distance - 0.5 * self.acceleration * left * left
+        return self.start + s * self.direction
+
+
+class SimulatedMachine:
+    """ Four axes moving through a queue of G0/G1 moves.
+
+    feedrate: initial F, in mm/min, until a code sets one
+    max_feedrate: cap on F, in mm/min
+    acceleration: in mm/s^2 """
+
+    def __init__(self, position = (0, 0, 0, 0), feedrate = 6000, max_feedrate = 30000, acceleration = 1000):
+        self.lock = threading.Lock()
+        self.position = np.array(position, dtype = float)
+        self.feedrate = feedrate
+        self.max_feedrate = max_feedrate
+        self.acceleration = acceleration
+        self.queue = []
+        self.stack = []
+
+    def advance(self, t):
+        """ Drop finished moves from the queue, returning the position at t """
+        while self.queue and t >= self.queue[0].t_end:
+            self.position = self.queue.pop(0).end
+        if self.queue:
+            return self.queue[0].position(t)
+        return self.position
+
+    def gcode(self, code):
+        """ Execute a line of G-code, returning the reply text """
+        words = code.split(';')[0].upper().split()
+        if not words:
+            return ""
+        if words[0] == 'M400':
+            # Wait for every queued move to finish
+            with self.lock:
+                finish = self.queue[-1].t_end if self.queue else 0
+            time.sleep(max(finish - time.time(), 0))
+            return ""
+        if words[0] == 'M120':
+            # Push the machine state - of which we only model the feedrate
+            self.stack.append(self.feedrate)
+            return ""
+        if words[0] == 'M121':
+            if self.stack:
+                self.feedrate = self.stack.pop()
+            return ""
+        if words[0] not in ('G0', 'G1', 'G00', 'G01'):
+            return ""
+
+        with self.lock:
+            now = time.time()
+            self.advance(now)
+            start = self.queue[-1].end if self.queue else self.position
+            t0 = self.queue[-1].t_end if self.queue else now
+            end = start.copy()
+            for w in words[1:]:
+                letter, value = w[0], w[1:]
+                try:
+                    value = float(value)
+                except ValueError:
+                    return f"""Error: {code}: bad parameter {w}"""
+                if letter in axis_letters:
+                    end[axis_letters.index(letter)] = value
+                elif letter == 'F':
+                    self.feedrate = value
+            move = Move(t0, start, end, min(self.feedrate, self.max_feedrate), self.acceleration)
+            if move.distance > 0:
+                self.queue.append(move)
+        return ""
+
+    def object_model(self):
+        with self.lock:
+            now = time.time()
+            position = self.advance(now)
+            busy = bool(self.queue)
+        return {'state': {'status': 'busy' if busy else 'idle', 'upTime': int(now)},
+                'move': {'axes': [{'letter': l, 'userPosition': round(float(p), 3), 'machinePosition': round(float(p), 3)}
+                                  for l, p in zip(axis_letters, position)]}}
+
+
+class Handler(socketserver.BaseRequestHandler):
+
+    def send(self, obj):
+        if self.server.send_delay:
+            time.sleep(self.server.send_delay)
+        sendblob(self.request, obj)
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+        self.send({'version': 11, 'id': server.next_id()})
+        messages = read_messages(sock)
+
+        init = next(messages, None)
+        if init is None:
+            return
+        self.send({'success': True})
+
+        try:
+            if init.get('mode') == 'subscribe':
+                self.subscribe(sock, messages)
+            elif init.get('mode') == 'command':
+                self.command(sock, messages)
+        except ConnectionError:
+            pass # The client hung up on us
+
+    def subscribe(self, sock, messages):
+        server = self.server
+        last = server.machine.object_model()
+        self.send(last)
+
+        for message in messages:
+            if message.get('command') != 'Acknowledge':
+                continue
+            # Wait for something to change, like DSF does
+            patch = None
+            while patch is None and not server.stopping.is_set():
+                time.sleep(server.patch_interval)
+                model = server.machine.object_model()
+                patch = diff(last, model)
+            if patch is None:
+                return
+            last = model
+            self.send(patch)
+
+    def command(self, sock, messages):
+        for message in messages:
+            if message.get('command') == 'SimpleCode':
+                result = ""
+                for line in message.get('code', '').split('\n'):
+                    result += self.server.machine.gcode(line)
+                self.send({'success': True, 'result': result})
+            else:
+                self.send({'success': False, 'errorType': 'NotSupportedException',
+                                    'errorMessage': f"""Unsupported command {message.get('command')}"""})
+
+
+class DuetSimulator(socketserver.ThreadingUnixStreamServer):
+    """ Serves a SimulatedMachine on a unix socket, for as long as it's open as
+    a context manager.
+
+    patch_interval: how often subscribers are checked for changes, in seconds
+    send_delay: pause before every message we send, in seconds. The real server
+    takes a moment to produce each message; set it to 0 to send back-to-back.
+    Remaining keyword arguments are passed on to SimulatedMachine. """
+
+    daemon_threads = True
+
+    def __init__(self, path, patch_interval = 0.025, send_delay = 0.005, **kwargs):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, Handler)
+        self.path = path
+        self.patch_interval = patch_interval
+        self.send_delay = send_delay
+        self.machine = SimulatedMachine(**kwargs)
+        self.stopping = threading.Event()
+        self.connections = 0
+        self.id_lock = threading.Lock()
+
+    def next_id(self):
+        with self.id_lock:
+            self.connections += 1
+            return self.connections
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stopping.set()
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: dsf_simulator.py <socket path> [number of moves to benchmark]")
+        exit()
+
+    with DuetSimulator(sys.argv[1]) as sim:
+
+        if len(sys.argv) < 3:
+            print("Serving a simulated Duet on " + sys.argv[1])
+            sim.thread.join()
+            exit()
+
+
+        latency = []
+        with MachineConnection(sys.argv[1]) as m:
+            for i in range(int(sys.argv[2])):
+                target = np.random.rand(3) * [300, 300, 50]
+                t = time.time()
+                m.move(target)
+                latency.append(time.time() - t)
+                print("Moved to ", target, " reported ", m.xyzu()[0:3])
+
+        print("Move latency percentiles (50/90/99, s): ", np.percentile(latency, [50, 90, 99]))
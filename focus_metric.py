@@ -0,0 +1,245 @@
+import cv2
+import numpy as np
+
+# Registry of every focus measure, by name. Each entry is a class whose
+# constructor takes an optional roi keyword, and whose instances are called
+# on a frame and return a scalar score - larger is sharper.
+metrics = {}
+
+def register(name):
+    """ Class decorator adding a focus measure to the registry """
+    def wrap(cls):
+        cls.name = name
+        metrics[name] = cls
+        return cls
+    return wrap
+
+def make_metric(name, **kwargs):
+    return metrics[name](**kwargs)
+
+
+class FocusMetric:
+    """ Shared plumbing for focus measures: region of interest cropping,
+    and (re)allocation of scratch buffers whenever the frame shape or type
+    changes.
+
+    roi: optional (x, y, width, height) pixel rectangle to restrict the metric to
+    min_size: smallest (height, width) the metric can score - anything smaller
+      (a roi partly off the frame, say) raises ValueError """
+
+    min_size = (1, 1)
+
+    def __init__(self, roi = None):
+        self.roi = roi
+        self.shape = None
+        self.dtype = None
+
+    def crop(self, frame):
+        if self.roi is None:
+            return frame
+        x, y, w, h = self.roi
+        return frame[y:y + h, x:x + w]
+
+    def prepare(self, frame):
+        """ Crop a frame, making sure the scratch buffers fit it """
+        img = self.crop(frame)
+        if img.shape != self.shape or img.dtype != self.dtype:
+            if img.shape[0] < self.min_size[0] or img.shape[1] < self.min_size[1]:
+                raise ValueError(f"""{self.name} needs a region of at least {self.min_size[1]} x {self.min_size[0]} pixels, got {img.shape[1]} x {img.shape[0]}""")
+            if img.dtype == np.uint8:
+                self.work, self.accumulator = np.int16, np.int64
+            else:
+                self.work, self.accumulator = np.float32, np.float64
+            self.allocate(img.shape)
+            self.shape, self.dtype = img.shape, img.dtype
+        return img
+
+    def allocate(self, shape):
+        pass
+
+    def sum_of_squares(self, buf):
+        v = buf.ravel()
+        return np.einsum('i,i->', v, v, dtype = self.accumulator)
+
+    def __call__(self, frame):
+        raise NotImplementedError
+
+
+@register('cmsl')
+class CMSLMetric(FocusMetric):
+    """ Scalar version of autofocus.CMSL, for when only the mean of the
+    contrast map is wanted.
+
+    The four 3x3 kernels in CMSL only ever produce two distinct differences:
+    |I(x+1) - I(x)| along rows and |I(y+1) - I(y)| along columns. Each pixel's
+    gradient sum is the two neighbouring horizontal differences plus the two
+    neighbouring vertical ones, so we take each difference once and add shifted
+    views of it together. The box filter is a local mean, so it doesn't change
+    the overall mean (up to border effects) and is skipped entirely.
+
+    8 bit frames are differenced in int16 (the gradient sum is at most 4 * 255)
+    and the squares are accumulated exactly in int64. All scratch space is
+    allocated on the first frame and reused for every following frame of the
+    same shape and type.
+
+    window: box filter size, only used by contrast_map """
+
+    def __init__(self, window = 10, roi = None):
+        super().__init__(roi)
+        self.window = window
+
+    def allocate(self, shape):
+        h, w, rest = shape[0], shape[1], tuple(shape[2:])
+        work = self.work
+        # Padded copy of the frame, with a one pixel reflected border to match
+        # filter2D's default BORDER_REFLECT_101
+        self.padded = np.empty((h + 2, w + 2) + rest, dtype = work)
+        self.dx = np.empty((h, w + 1) + rest, dtype = work)
+        self.dy = np.empty((h + 1, w) + rest, dtype = work)
+        self.g = np.empty((h, w) + rest, dtype = work)
+
+    def gradient(self, frame):
+        """ Compute the summed absolute gradient of a frame into self.g """
+        img = self.prepare(frame)
+        p, dx, dy, g = self.padded, self.dx, self.dy, self.g
+        np.copyto(p[1:-1, 1:-1], img, casting = 'unsafe')
+        p[1:-1, 0] = p[1:-1, 2]
+        p[1:-1, -1] = p[1:-1, -3]
+        p[0, 1:-1] = p[2, 1:-1]
+        p[-1, 1:-1] = p[-3, 1:-1]
+
+        np.subtract(p[1:-1, 1:], p[1:-1, :-1], out = dx)
+        np.abs(dx, out = dx)
+        np.subtract(p[1:, 1:-1], p[:-1, 1:-1], out = dy)
+        np.abs(dy, out = dy)
+
+        np.add(dx[:, :-1], dx[:, 1:], out = g)
+        g += dy[:-1, :]
+        g += dy[1:, :]
+        return g
+
+    def __call__(self, frame):
+        """ Mean of the CMSL contrast map over the region of interest """
+        g = self.gradient(frame)
+        return float(self.sum_of_squares(g)) / g.size
+
+    def contrast_map(self, frame):
+        """ Full CMSL contrast map, equivalent to autofocus.CMSL on the
+        region of interest """
+        g = self.gradient(frame).astype(np.float32)
+        return cv2.boxFilter(g * g, -1, (self.window, self.window), normalize = True)
+
+
+@register('tenengrad')
+class TenengradMetric(FocusMetric):
+    """ Mean squared Sobel gradient magnitude. The 3x3 Sobel kernels are
+    separable, so each is a [1, 2, 1] smoothing along one axis followed by a
+    central difference along the other. Only the interior of the frame is used. """
+
+    min_size = (3, 3)
+
+    def allocate(self, shape):
+        h, w, rest = shape[0], shape[1], tuple(shape[2:])
+        self.img = np.empty(shape, dtype = self.work)
+        self.smooth_y = np.empty((h - 2, w) + rest, dtype = self.work)
+        self.smooth_x = np.empty((h, w - 2) + rest, dtype = self.work)
+        self.gx = np.empty((h - 2, w - 2) + rest, dtype = self.work)
+        self.gy = np.empty((h - 2, w - 2) + rest, dtype = self.work)
+
+    def __call__(self, frame):
+        src = self.prepare(frame)
+        img = self.img
+        np.copyto(img, src, casting = 'unsafe')
+
+        sy, sx = self.smooth_y, self.smooth_x
+        np.add(img[:-2], img[2:], out = sy)
+        sy += img[1:-1]
+        sy += img[1:-1]
+        np.subtract(sy[:, 2:], sy[:, :-2], out = self.gx)
+
+        np.add(img[:, :-2], img[:, 2:], out = sx)
+        sx += img[:, 1:-1]
+        sx += img[:, 1:-1]
+        np.subtract(sx[2:], sx[:-2], out = self.gy)
+
+        total = self.sum_of_squares(self.gx) + self.sum_of_squares(self.gy)
+        return float(total) / self.gx.size
+
+
+@register('laplacian')
+class LaplacianVarianceMetric(FocusMetric):
+    """ Variance of the 4-neighbour Laplacian over the interior of the frame """
+
+    min_size = (3, 3)
+
+    def allocate(self, shape):
+        h, w, rest = shape[0], shape[1], tuple(shape[2:])
+        self.img = np.empty(shape, dtype = self.work)
+        self.lap = np.empty((h - 2, w - 2) + rest, dtype = self.work)
+        self.center = np.empty((h - 2, w - 2) + rest, dtype = self.work)
+
+    def __call__(self, frame):
+        src = self.prepare(frame)
+        img, lap = self.img, self.lap
+        np.copyto(img, src, casting = 'unsafe')
+
+        np.add(img[:-2, 1:-1], img[2:, 1:-1], out = lap)
+        lap += img[1:-1, :-2]
+        lap += img[1:-1, 2:]
+        np.multiply(img[1:-1, 1:-1], 4, out = self.center)
+        lap -= self.center
+
+        n = lap.size
+        mean = float(lap.sum(dtype = self.accumulator)) / n
+        return float(self.sum_of_squares(lap)) / n - mean * mean
+
+
+@register('brenner')
+class BrennerMetric(FocusMetric):
+    """ Brenner's gradient: mean squared difference between pixels two columns apart """
+
+    min_size = (1, 3)
+
+    def allocate(self, shape):
+        h, w, rest = shape[0], shape[1], tuple(shape[2:])
+        self.img = np.empty(shape, dtype = self.work)
+        self.diff = np.empty((h, w - 2) + rest, dtype = self.work)
+
+    def __call__(self, frame):
+        src = self.prepare(frame)
+        img = self.img
+        np.copyto(img, src, casting = 'unsafe')
+        np.subtract(img[:, 2:], img[:, :-2], out = self.diff)
+        return float(self.sum_of_squares(self.diff)) / self.diff.size
+
+
+@register('fft')
+class FFTMetric(FocusMetric):
+    """ Fraction of spectral energy above a cutoff spatial frequency.
+
+    cutoff: radius of the excluded low frequency disc, as a fraction of Nyquist """
+
+    def __init__(self, cutoff = 0.25, roi = None):
+        super().__init__(roi)
+        self.cutoff = cutoff
+
+    def allocate(self, shape):
+        h, w = shape[0], shape[1]
+        self.img = np.empty(shape, dtype = np.float32)
+        fy = np.fft.fftfreq(h)[:, None]
+        fx = np.fft.rfftfreq(w)[None, :]
+        # Frequencies are in cycles/pixel, so Nyquist is 0.5
+        high = (fx**2 + fy**2) > (0.5 * self.cutoff)**2
+        self.high = high.reshape(high.shape + (1,) * (len(shape) - 2))
+
+    def __call__(self, frame):
+        src = self.prepare(frame)
+        img = self.img
+        np.copyto(img, src, casting = 'unsafe')
+        img -= img.mean(axis = (0, 1))
+
+        power = np.abs(np.fft.rfft2(img, axes = (0, 1)))**2
+        total = power.sum()
+        if total == 0:
+            return 0.0
+        return float(power.sum(where = self.high) / total)
@@ -0,0 +1,216 @@
+import threading
+import time
+import json
+import os
+import cv2
+import numpy as np
+
+from scipy.spatial import KDTree
+
+
+class Camera:
+    """ Common interface for every camera backend. Frames are always BGR
+    arrays of shape (height, width, 3), as OpenCV would give them.
+
+    shape: the shape of every frame
+    grab(out): fill a preallocated array with a new frame, returning False on failure
+    read(): a new frame, with the same signature as cv2.VideoCapture.read """
+
+    shape = None
+
+    def grab(self, out):
+        raise NotImplementedError
+
+    def read(self):
+        frame = np.empty(self.shape, dtype = np.uint8)
+        ret = self.grab(frame)
+        return ret, frame if ret else None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class OpenCVCamera(Camera):
+    """ A V4L2 (or any other OpenCV supported) camera """
+
+    def __init__(self, device = 0, resolution = None):
+        self.cam = cv2.VideoCapture(device)
+        if resolution is not None:
+            self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+            self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        self.shape = (int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+
+    def grab(self, out):
+        ret, _ = self.cam.read(out)
+        return ret
+
+    def close(self):
+        self.cam.release()
+
+
+class PiCamera(Camera):
+    """ The Raspberry Pi camera, capturing from the video port """
+
+    def __init__(self, resolution, framerate = 24, warmup = 2):
+        # Only available on the Pi itself
+        import picamera
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = resolution
+        self.camera.framerate = framerate
+        self.shape = (resolution[1], resolution[0], 3)
+        time.sleep(warmup)
+
+    def grab(self, out):
+        self.camera.capture(out, 'bgr', use_video_port = True)
+        return True
+
+    def close(self):
+        self.camera.close()
+
+
+class RecordedCamera(Camera):
+    """ Replays a recorded dataset, returning the stored frame taken nearest the
+    machine's current XYZ - so anything driving a (simulated) machine sees the
+    images it would have seen at that position.
+
+    The dataset is in the layout written by grab_frame.py: a meta.json whose
+    'photos' maps frame numbers to [x, y, z], and a <number>.png per frame.
+    grab_frame.py stores z relative to the bed focus, so that's added back on
+    if the dataset includes the calibration. It also stores frames transposed,
+    so they're transposed back on loading - giving (height, width, 3) frames
+    like the live camera's, which get transposed again wherever that is.
+
+    machine: anything with an xyzu() method
+    framerate: optional frame rate to throttle to, otherwise frames come as fast as they're asked for """
+
+    def __init__(self, directory, machine, framerate = None):
+
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        z_offset = meta['cal']['bed_focus'] if 'cal' in meta else 0
+
+        keys = list(meta['photos'])
+        self.frames = [np.ascontiguousarray(np.transpose(cv2.imread(os.path.join(directory, str(k) + ".png")), axes = (1,0,2)))
+                       for k in keys]
+        self.positions = np.array([meta['photos'][k] for k in keys], dtype = float)
+        self.positions[:, 2] += z_offset
+        self.tree = KDTree(self.positions)
+
+        self.machine = machine
+        self.shape = self.frames[0].shape
+        self.interval = None if framerate is None else 1 / framerate
+        self.last = 0
+
+    def grab(self, out):
+        if self.interval is not None:
+            wait = self.last + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last = time.time()
+        _, i = self.tree.query(self.machine.xyzu()[0:3])
+        np.copyto(out, self.frames[i])
+        return True
+
+
+def capture_loop(source):
+
+    while not source.terminate_event.is_set():
+        slot = source.sequence % source.size
+        started = time.time()
+        if not source.camera.grab(source.frames[slot]):
+            time.sleep(0.01)
+            continue
+        captured = time.time()
+        position = source.machine.xyzu() if source.machine is not None else np.nan
+
+        with source.condition:
+            source.started[slot] = started
+            source.times[slot] = captured
+            source.positions[slot] = position
+            source.sequence += 1
+            source.condition.notify_all()
+
+
+class CaptureThread:
+    """ Keeps a camera capturing on its own thread, into a preallocated ring
+    buffer of frames. Each frame is tagged with the time its capture started,
+    the time it finished, and the machine position (xyzu) once it finished.
+
+    Because the camera is drained continuously, nothing ever sits in its
+    internal queue - so asking for the first frame started after some moment
+    really does give a frame exposed after it, without throwing any away.
+
+    camera: a Camera to capture from
+    machine: optional MachineConnection to tag frames with positions
+    size: number of frames in the ring buffer - readers can look back size - 2 frames """
+
+    def __init__(self, camera, machine = None, size = 8):
+        self.camera = camera
+        self.machine = machine
+        self.size = size
+        self.frames = np.empty((size,) + tuple(camera.shape), dtype = np.uint8)
+        self.started = np.full(size, -np.inf)
+        self.times = np.full(size, -np.inf)
+        self.positions = np.full((size, 4), np.nan)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.terminate_event = threading.Event()
+        self.worker = None
+
+    def __enter__(self):
+        self.worker = threading.Thread(target = capture_loop, args = (self,), daemon = True)
+        self.worker.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.terminate_event.set()
+        self.worker.join()
+
+    def copy_out(self, slot, out):
+        if out is None:
+            out = self.frames[slot].copy()
+        else:
+            np.copyto(out, self.frames[slot])
+        return out, self.times[slot], self.positions[slot].copy()
+
+    def frame_after(self, t, timeout = None, out = None):
+        """ Wait for the first frame whose capture started after time t.
+        Returns (frame, capture time, position), or None on timeout. The frame
+        is copied into out if it's given, and into a new array otherwise. """
+
+        def find():
+            # The slot at sequence % size is being written into, so skip it
+            for n in range(max(self.sequence - self.size + 1, 0), self.sequence):
+                if self.started[n % self.size] > t:
+                    return n % self.size
+            return None
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: find() is not None, timeout):
+                return None
+            return self.copy_out(find(), out)
+
+    def latest(self, out = None):
+        """ The most recently captured frame, as (frame, capture time, position) """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > 0)
+            return self.copy_out((self.sequence - 1) % self.size, out)
+
+    def fresh(self, timeout = None, out = None):
+        """ The first frame started after this call """
+        return self.frame_after(time.time(), timeout, out)
+
+    def after_idle(self, timeout = None, out = None):
+        """ The first frame started after the machine is idle """
+        self.machine.idle_event.wait()
+        return self.frame_after(time.time(), timeout, out)
+
+    def read(self):
+        """ Drop-in for cv2.VideoCapture.read, returning a fresh frame """
+        return True, self.fresh()[0]
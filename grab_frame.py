@@ -1,23 +1,23 @@
 import numpy as np
-import time
 import math
 import random
 import sys
 import json
-import tempfile
-import shutil
-import cv2
-import os
-import picamera
 from machine_interface import MachineConnection
+from frame_source import CaptureThread, PiCamera
+from motion_planner import Planner, Stop
+from photo_stream import FrameEncoder, TarWriter
 
 
 
-def frame_getter(resolution, camera):
+def frame_getter(source):
+    """ Returns a function giving the first frame captured once the machine is
+    idle, transposed. Every call reuses the same output array. """
+
+    output = np.empty(source.frames.shape[1:], dtype = np.uint8)
 
     def ret():
-        output = np.empty((resolution[1], resolution[0], 3), dtype=np.uint8)
-        camera.capture(output, 'rgb', use_video_port = True)
+        source.after_idle(out = output)
         return np.transpose(output, axes = (1,0,2))
 
     return ret
@@ -47,27 +47,30 @@ if __name__ == '__main__':
         
     with MachineConnection('/var/run/dsf/dcs.sock') as m:
 
-        with picamera.PiCamera() as camera:
-    
-            camera.resolution = cal['resolution']
-            camera.framerate = 24
-            time.sleep(2)
+        with PiCamera(cal['resolution']) as camera:
+
+            with CaptureThread(camera, machine = m) as source:
+
+                getter = frame_getter(source)
+                writer = TarWriter(sys.stdout.buffer)
+                writer.add("cal.json", json.dumps(cal).encode())
+
+                meta = {}
 
-            tmp = tempfile.mkdtemp()
-            getter = frame_getter(cal['resolution'], camera)
+                # Frames are still numbered in command line order, but taken in
+                # whichever order is quickest. Each is encoded and streamed out
+                # while the machine moves on to the next.
+                stops = [Stop(x, y, z + cal['bed_focus']) for x,y,z in targets]
+                planner = Planner()
+                order = planner.order(stops, start = m.xyzu()[0:3])
 
-            meta = {}
-            
-            for i,(x,y,z) in enumerate(targets):
-                m.move(x,y,z + cal['bed_focus'])
-                cv2.imwrite(os.path.join(tmp,str(i) + ".png"), getter())
-                meta[i] = [x,y,z]
+                with FrameEncoder(writer) as encoder:
 
+                    def grab(i, stop):
+                        meta[i] = list(targets[i])
+                        encoder.put(i, getter(), meta[i])
 
-            with open(os.path.join(tmp,"meta.json"), "w") as f:
-                json.dump({'cal':cal, 'photos':meta}, f)
-                                   
-            os.system(f"""tar -cf - -C {tmp} .""")
+                    planner.run(m, stops, order, at_stop = grab)
 
-                
-            shutil.rmtree(tmp)
+                writer.add("meta.json", json.dumps({'cal':cal, 'photos':meta}).encode())
+                writer.close()
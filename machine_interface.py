@@ -1,4 +1,6 @@
 import threading
+import concurrent.futures
+import collections
 import socket
 import time
 import json
@@ -23,27 +25,39 @@ def index_exists(obj, idx):
         return False
 
 def recursive_update(target, patch):
+    """ The result of applying a patch to target. Copy on write: the containers
+    along each patched path are copied, everything else is shared with target,
+    and target itself is never modified. """
     if patch == {}:
         return target
     
     it = dict_or_list_iter(patch)
     if not it:
         return patch
-    
+    if not isinstance(target, (dict, list)):
+        return patch
+
+    updated = copy.copy(target)
     for k, v in it:
         if index_exists(target, k):         
-            target[k] = recursive_update(target[k], v)
+            updated[k] = recursive_update(target[k], v)
         else:
-            target[k] = v
+            updated[k] = v
            
-    return target
+    return updated
     
 
 def partial_update(state, template, patch):
+    """ Apply the parts of a patch picked out by a template to the flat dict
+    state, in place. Returns True if any of them were present.
+
+    This walks the template and patch together on every call - connections
+    use a CompiledTemplate instead, which does the same thing faster. """
     it = dict_or_list_iter(patch)
     if not it:
-        return
+        return False
 
+    changed = False
     for k,v in it:
         if not index_exists(template, k):
             continue # Don't care about this whole sub-tree.
@@ -54,8 +68,10 @@ def partial_update(state, template, patch):
                 state[t] = recursive_update(state[t], v)
             else:
                 state[t] = v
+            changed = True
         else:
-            partial_update(state, t, v)
+            changed = partial_update(state, t, v) or changed
+    return changed
 
 def keys_in_template(template):
     """ Traverse a template and return all keys that will eventually be used. """
@@ -68,18 +84,139 @@ def keys_in_template(template):
                 yield from keys_in_template(v)
 
 
+def template_paths(template, prefix = ()):
+    """ Every (path, key) pair in a template, where path is the tuple of object
+    model keys and indices leading to the value stored under key """
+    if isinstance(template, str):
+        yield prefix, template
+    else:
+        it = dict_or_list_iter(template)
+        if it:
+            for k,v in it:
+                yield from template_paths(v, prefix + (k,))
+
+
+def compile_node(template):
+    """ A template as nested dicts all the way down, with string leaves """
+    if isinstance(template, str):
+        return template
+    it = dict_or_list_iter(template)
+    if not it:
+        return {}
+    return {k: compile_node(v) for k, v in it}
+
+
+absent = object()
+
+def apply_node(state, node, patch, changed):
+    """ Apply a patch to the flat dict state, following only the keys and
+    indices in a compiled template node. Every key updated is appended to changed. """
+    if type(patch) is dict:
+        get = patch.get
+        for k, child in node.items():
+            v = get(k, absent)
+            if v is absent or v == {}:
+                continue
+            if type(child) is str:
+                state[child] = recursive_update(state[child], v) if child in state else v
+                changed.append(child)
+            else:
+                apply_node(state, child, v, changed)
+    elif type(patch) is list:
+        n = len(patch)
+        for k, child in node.items():
+            if type(k) is not int or k >= n:
+                continue
+            v = patch[k]
+            if v == {}:
+                continue # An unchanged list element
+            if type(child) is str:
+                state[child] = recursive_update(state[child], v) if child in state else v
+                changed.append(child)
+            else:
+                apply_node(state, child, v, changed)
+    return changed
+
+
+class CompiledTemplate:
+    """ A template compiled once into a table of the object model keys we track
+    at each level. Applying a patch then only looks up those keys in it, with
+    no type checks on the template side - rather than walking every branch of
+    the patch, tracked or not, against the template.
+
+    paths: every (path, key) pair in the template, see template_paths
+    keys: every key the template stores values under """
+
+    def __init__(self, template):
+        self.template = template
+        self.paths = list(template_paths(template))
+        self.keys = [key for _, key in self.paths]
+        self.root = compile_node(template) if not isinstance(template, str) else {}
+
+    def __bool__(self):
+        return bool(self.paths)
+
+    def apply(self, state, patch):
+        """ As partial_update(state, template, patch), but returning the list
+        of keys that were updated """
+        return apply_node(state, self.root, patch, [])
+
+
 
 def sendblob(socket,obj):
     socket.sendall(json.dumps(obj).encode())
 
-    
-def getblob(socket, buffer_size = 65536):
-    data = socket.recv(buffer_size).decode()
-    return json.loads(data)
 
+class BlobReader:
+    """ Reads a stream of concatenated JSON documents from a socket.
 
-def ignoreblob(socket, buffer_size = 65536):
-    socket.recv(buffer_size).decode()
+    DSF doesn't frame its messages, so a single recv can hold part of a message
+    (large full-state dumps), or several of them (bursts of patches). We
+    accumulate everything received in one buffer, and decode documents off the
+    front of it as they complete. Every document DSF sends is an object, so a
+    decode is only attempted when the buffer ends in a closing brace. """
+
+    def __init__(self, socket, buffer_size = 65536):
+        self.socket = socket
+        self.chunk = bytearray(buffer_size)
+        self.view = memoryview(self.chunk)
+        self.buffer = bytearray()
+        self.decoder = json.JSONDecoder()
+        self.pending = []
+
+    def decode(self):
+        """ Move every complete document in the buffer onto the pending list """
+        if not self.buffer.rstrip().endswith(b'}'):
+            return
+        text = self.buffer.decode()
+        end, n = 0, len(text)
+        while True:
+            while end < n and text[end].isspace():
+                end += 1
+            if end == n:
+                break
+            try:
+                obj, end = self.decoder.raw_decode(text, end)
+            except json.JSONDecodeError:
+                break
+            self.pending.append(obj)
+        if end == n:
+            self.buffer.clear()
+        else:
+            del self.buffer[:len(text[:end].encode())]
+
+    def get(self):
+        """ Return the next document, blocking until it has fully arrived """
+        while not self.pending:
+            n = self.socket.recv_into(self.chunk)
+            if n == 0:
+                raise ConnectionError("DSF socket closed")
+            self.buffer += self.view[:n]
+            self.decode()
+        return self.pending.pop(0)
+
+    def ignore(self):
+        self.get()
 
 
     
@@ -87,34 +224,224 @@ internal_template = {'move': {'axes' : {0 : {'userPosition': 'x'},
                                         1 : {'userPosition': 'y'},
                                         2 : {'userPosition': 'z'},
                                         3 : {'userPosition': 'u'}}}}
+internal_paths = CompiledTemplate(internal_template)
+
+
+def apply_message(state, internal_state, template, message):
+    """ Apply a full state or patch to the tracked and internal state, given the
+    CompiledTemplate for the tracked state (empty to track everything). The
+    internal state is updated in place, while the tracked state is left alone
+    and the updated version returned - the same object if nothing in it changed.
+
+    Returns the updated tracked state and a list of (key, new value) for every
+    key that changed, tracked and internal alike. """
+    if template:
+        updated = dict(state)
+        keys = template.apply(updated, message)
+        if not keys:
+            updated = state
+    else:
+        updated = recursive_update(state, message)
+        keys = list(message)
+    changes = [(k, updated[k]) for k in keys]
+    changes += [(k, internal_state[k]) for k in internal_paths.apply(internal_state, message)]
+    return updated, changes
+
+
+# A consistent view of the tracked object model. version counts the patches
+# that have changed it, so readers can tell if anything's new since they last looked.
+StateSnapshot = collections.namedtuple('StateSnapshot', ['version', 'state'])
+
+class VersionedState:
+    """ The tracked object model as a succession of snapshots. Patches never
+    modify a published snapshot: they build a new one, sharing every part the
+    patch didn't touch, and swap it in with a single assignment. So readers
+    get a consistent view without copying or locking - as long as they treat
+    it as read-only. """
+
+    def __init__(self, template):
+        self.template = template
+        state = {k: {} for k in template.keys}
+        self.snapshot = StateSnapshot(0, state)
+
+    def apply(self, message, internal_state):
+        """ Apply a message, returning the changes as apply_message does """
+        version, state = self.snapshot
+        updated, changes = apply_message(state, internal_state, self.template, message)
+        if updated is not state:
+            self.snapshot = StateSnapshot(version + 1, updated)
+        return changes
+
+
+class ChangeWatchers:
+    """ Callbacks on changes to individual keys: any key in the template, and
+    x, y, z and u for the axis positions.
+
+    Callbacks are called as callback(key, new value) on whichever thread applies
+    patches, after it has released the state lock - so they can read the
+    connection's state, but should return quickly, as the next patch waits on
+    them. A callback returning True is removed. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.futures = set()
+
+    def add(self, key, callback):
+        with self.lock:
+            self.callbacks.setdefault(key, []).append(callback)
+
+    def remove(self, key, callback):
+        with self.lock:
+            if callback in self.callbacks.get(key, []):
+                self.callbacks[key].remove(callback)
+
+    def when(self, key, predicate, current):
+        """ A future resolving to the first value of key for which predicate is
+        true, or the next value of key at all if predicate is None. With a
+        predicate, the current value - from current() - is checked as well. """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.forget)
+
+        def check(key, value):
+            if future.done():
+                return True # Cancelled, or already resolved by the current value
+            if predicate is not None and not predicate(value):
+                return False
+            try:
+                future.set_result(value)
+            except concurrent.futures.InvalidStateError:
+                pass
+            return True
+
+        self.add(key, check)
+        if predicate is not None:
+            try:
+                value = current()
+            except KeyError:
+                return future # Nothing yet to check
+            if check(key, value):
+                self.remove(key, check)
+        return future
+
+    def forget(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def fail(self, error):
+        """ Fail every future from when that's still waiting with error, as
+        no more changes are coming """
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            try:
+                future.set_exception(error)
+            except concurrent.futures.InvalidStateError:
+                pass
+
+    def dispatch(self, changes):
+        if not self.callbacks:
+            return
+        for key, value in changes:
+            with self.lock:
+                callbacks = list(self.callbacks.get(key, []))
+            for callback in callbacks:
+                if callback(key, value):
+                    self.remove(key, callback)
+
+
+def message_status(message):
+    """ The machine status in a full state or patch, or None if it hasn't changed """
+    return message.get('state', {}).get('status')
+
+def check_replies(codes, replies):
+    """ Pull the result text out of each SimpleCode reply, raising GCodeError
+    for the first one that failed """
+    results = []
+    for code, reply in zip(codes, replies):
+        if not reply.get('success', True):
+            raise GCodeError(code, reply.get('errorMessage', ''))
+        result = reply.get('result') or ''
+        if result.startswith('Error'):
+            raise GCodeError(code, result)
+        results.append(result)
+    return results
+
+
+# What a position waiter's future resolves to: the seconds from sending the move
+# to seeing it finish, whether it finished within tolerance of its target, and
+# where it finished.
+Settled = collections.namedtuple('Settled', ['time', 'reached', 'position'])
+
+class PositionWaiter:
+    """ Tracks a move until the streamed userPositions reach its target with the
+    machine idle, resolving a future with a Settled.
+
+    Only patches received after the move has been acknowledged are considered, so
+    the idle status from before the move doesn't count. A move that can't reach
+    its target (soft limits, say) still resolves, unreached, once the machine has
+    been seen busy and goes idle again - or, if it never goes busy at all (it
+    was already clamped at the limit), when expire is called busy_timeout later.
+
+    target: dict of internal_state key (x, y, z, u) to position """
+
+    def __init__(self, target, tolerance = 0.01):
+        self.target = target
+        self.tolerance = tolerance
+        self.future = concurrent.futures.Future()
+        self.sent = time.time()
+        self.seen_busy = False
+
+    def reached(self, internal_state):
+        return all(abs(internal_state[k] - v) <= self.tolerance for k, v in self.target.items())
+
+    def check(self, internal_state, idle):
+        """ Called with every patch. Returns True once the future is resolved. """
+        if not idle:
+            self.seen_busy = True
+            return False
+        reached = self.reached(internal_state)
+        if reached or self.seen_busy:
+            position = {k: internal_state[k] for k in self.target}
+            self.future.set_result(Settled(time.time() - self.sent, reached, position))
+            return True
+        return False
+
+    def expire(self, internal_state, idle):
+        """ Resolve the future, unreached, if the machine is idle and hasn't been
+        seen busy since the move was sent. Returns True if it did. """
+        if self.future.done() or self.seen_busy or not idle:
+            return False
+        position = {k: internal_state[k] for k in self.target}
+        self.future.set_result(Settled(time.time() - self.sent, self.reached(internal_state), position))
+        return True
 
+def check_waiters(waiters, internal_state, idle):
+    waiters[:] = [w for w in waiters if not w.check(internal_state, idle)]
 
-def worker_loop(socket_addr, state, internal_state, template, idle_event, busy_event, terminate_event, ready_event, state_lock):
 
-    # Figure out which bits of state we're going to track
-    if template is not None:
-        for k in keys_in_template(template):
-            state[k] = {}
+def worker_loop(socket_addr, states, internal_state, idle_event, busy_event, terminate_event, ready_event, state_lock, waiters, watchers, recorder):
+
     # Connect to a socket for getting state updates
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.connect(socket_addr)
     sock.setblocking(True)
 
+    reader = BlobReader(sock)
+
     sendblob(sock,{"mode":"subscribe","version": 8, "subscriptionMode": "Patch"})
     # Two messages to ignore, and then the full state
-    ignoreblob(sock) 
-    ignoreblob(sock)
+    reader.ignore()
+    reader.ignore()
 
     # Perform the first state update - no need to lock here,
     # as the other thread is waiting on our ready signal
-    message = getblob(sock)
-    if template:  
-        partial_update(state, template, message)
-    else:
-        recursive_update(state, message)
-    partial_update(internal_state, internal_template, message)
+    message = reader.get()
+    states.apply(message, internal_state)
     
-    if message['state']['status'] == 'idle':
+    if message_status(message) == 'idle':
         idle_event.set()
         busy_event.clear()
     else:
@@ -127,35 +454,45 @@ def worker_loop(socket_addr, state, internal_state, template, idle_event, busy_e
     while not terminate_event.is_set():
         # Let the socket know we got that, and get a new update
         sendblob(sock, {"command" : "Acknowledge"})
-        message = getblob(sock)
+        message = reader.get()
+        new_status = message_status(message)
         with state_lock:
-            # Apply the update
-            if template:
-                partial_update(state, template, message)
-            else:
-                recursive_update(state, message)
-
-            partial_update(internal_state, internal_template, message)
-
-        if 'state' in message:
-            st = message['state']
-            if 'status' in st:
-                new_status = st['status']
+            changes = states.apply(message, internal_state)
+            if new_status is not None:
                 if new_status != 'idle':
                     busy_event.set()
                     idle_event.clear()
                 else:
                     busy_event.clear()
                     idle_event.set()
+            if waiters:
+                check_waiters(waiters, internal_state, idle_event.is_set())
+            if recorder is not None:
+                recorder.patch(internal_state, idle_event.is_set())
+        watchers.dispatch(changes)
 
     # Once we get the signal to terminate, close the socket and die
     sock.close()
 
 
 
+class GCodeError(Exception):
+    """ A G-code was rejected by DSF, or replied with an error """
+
+    def __init__(self, code, message):
+        super().__init__(f"""{code}: {message}""")
+        self.code = code
+        self.message = message
+
+
 class MachineConnection:
 
-    def __init__(self, socket, template = None):
+    # Most codes gcode() will have awaiting replies at once when pipelining
+    pipeline_window = 64
+    # Seconds a move has to start in before it's taken not to be going anywhere
+    busy_timeout = 1
+
+    def __init__(self, socket, template = None, recorder = None):
 
         self.idle_event = threading.Event()
         self.busy_event = threading.Event()
@@ -163,20 +500,25 @@ class MachineConnection:
         self.ready_event = threading.Event()
         self.state_lock = threading.Lock()
         self.worker = None
-        self.state = {}
         self.internal_state = {}
+        self.waiters = []
+        self.watchers = ChangeWatchers()
         if template is None:
             self.template = {}
         else:
             self.template = template
+        self.states = VersionedState(CompiledTemplate(self.template))
         self.socket_address = socket
+        # Optional machine_recorder.Recorder, logging every patch and command
+        self.recorder = recorder
 
     def __enter__(self):
         # Start the thread that polls state
         self.worker = threading.Thread(target = worker_loop,
-                                       args = (self.socket_address, self.state, self.internal_state,
-                                               self.template, self.idle_event, self.busy_event,
-                                               self.terminate_event, self.ready_event, self.state_lock))
+                                       args = (self.socket_address, self.states, self.internal_state,
+                                               self.idle_event, self.busy_event,
+                                               self.terminate_event, self.ready_event, self.state_lock,
+                                               self.waiters, self.watchers, self.recorder))
         self.worker.start()
         self.ready_event.wait()
         # Open a socket for sending gcode from this thread as well
@@ -184,24 +526,64 @@ class MachineConnection:
         self.sock.connect(self.socket_address)
         self.sock.setblocking(True)
 
+        self.reader = BlobReader(self.sock)
+
         sendblob(self.sock, {"mode":"command","version": 8})
-        ignoreblob(self.sock) # Ignore a welcome message - should check it...
+        # Ignore the server's welcome message and the reply to ours - should check them...
+        self.reader.ignore()
+        self.reader.ignore()
         
         return self
 
-    def gcode(self, codes, block = True):
-        
+    def gcode(self, codes, block = True, pipeline = True, combine = False, on_reply = None):
+        """ Send one or more lines of G-code, returning the reply text for each.
+
+        With pipeline set, codes are written back-to-back (up to pipeline_window
+        of them awaiting replies) and the replies collected afterwards, so a
+        batch costs about one round trip rather than one per line. With combine
+        set, they're sent as a single multi-line code with a single reply.
+        DSF executes codes on a channel in order either way.
+
+        on_reply: optional on_reply(index, result), called as each reply
+        arrives - until the first error - to follow the progress of a long batch
+
+        Raises GCodeError for the first code that was rejected or replied with
+        an error, once every reply has been read. """
+
         if isinstance(codes, str):
             codes = [codes]
+        if combine:
+            codes = ['\n'.join(codes)]
+
+        window = self.pipeline_window if pipeline else 1
+        replies, sent, sent_at, depth = [], 0, [], []
+        while len(replies) < len(codes):
+            while sent < len(codes) and sent - len(replies) < window:
+                sent_at.append(time.time())
+                depth.append(sent - len(replies))
+                sendblob(self.sock, {"code" : codes[sent], "channel" : 0, "command" : "SimpleCode"})
+                sent += 1
+            replies.append(self.reader.get())
+            n = len(replies) - 1
+            if self.recorder is not None:
+                self.recorder.command(codes[n], sent_at[n], time.time(), depth[n])
+            if on_reply is not None:
+                try:
+                    result = check_replies(codes[n:n + 1], replies[n:])[0]
+                except GCodeError:
+                    on_reply = None # Anything after an error can't be counted as progress
+                else:
+                    on_reply(n, result)
 
-        for g in codes:
-            sendblob(self.sock, {"code" : g, "channel" : 0, "command" : "SimpleCode"})
-            getblob(self.sock) # Again, should check this...
+        results = check_replies(codes, replies)
 
         if block and self.busy_event.wait(1):
             self.idle_event.wait()
 
-    def move(self,*args,**kwargs):
+        return results
+
+    def move_axes(self,*args,**kwargs):
+        """ The axis letter to value map for a move - see move """
 
         n, moves = len(args), {}
         sequence = ['X','Y','Z','E']
@@ -217,14 +599,52 @@ class MachineConnection:
                 moves[s] = kwargs[s]
         if 'f' in kwargs:
             moves['F'] = kwargs['f']
+        elif 'F' in kwargs:
+            moves['F'] = kwargs['F']
 
-        gcode = 'G0 ' + ' '.join(axis + str(value) for axis, value in moves.items())
-        
-        if 'block' in kwargs:
-            self.gcode(gcode, block = kwargs['block'])
-        else:
-            self.gcode(gcode)
+        return moves
 
+    def move_code(self,*args,**kwargs):
+        """ The G0 for a move, without sending it - see move """
+
+        moves = self.move_axes(*args, **kwargs)
+        if moves is None:
+            return
+        return 'G0 ' + ' '.join(axis + str(value) for axis, value in moves.items())
+
+    def move(self,*args,**kwargs):
+        """ Move to a position, given positionally as X, Y, Z (and E), as a single
+        sequence of them, or by keyword. f or F sets the feedrate.
+
+        Returns a future resolving to a Settled once the tracked positions have
+        reached the target (within tolerance, default 0.01mm) and the machine is
+        idle. Unless block = False, that has already happened by the time this
+        returns. """
+
+        moves = self.move_axes(*args, **kwargs)
+        if moves is None:
+            return
+        gcode = self.move_code(*args, **kwargs)
+
+        target = {axis.lower(): float(v) for axis, v in moves.items() if axis in 'XYZU'}
+        waiter = PositionWaiter(target, kwargs.get('tolerance', 0.01))
+        self.gcode(gcode, block = False)
+        # Only patches from here on can resolve it - unless we're already there
+        with self.state_lock:
+            if not waiter.check(self.internal_state, self.idle_event.is_set()):
+                self.waiters.append(waiter)
+                threading.Timer(self.busy_timeout, self.expire, args = (waiter,)).start()
+
+        if kwargs.get('block', True):
+            waiter.future.result()
+        return waiter.future
+
+
+    def expire(self, waiter):
+        """ Give up on a move the machine never started """
+        with self.state_lock:
+            if waiter.expire(self.internal_state, self.idle_event.is_set()):
+                self.waiters.remove(waiter)
 
     def xyzu(self):
         vect = np.empty(4)
@@ -238,9 +658,47 @@ class MachineConnection:
     def is_busy(self):
         return self.busy_event.is_set()
         
+    def snapshot(self):
+        """ The latest StateSnapshot of the tracked object model """
+        return self.states.snapshot
+
     def current_state(self):
+        """ The tracked object model. This is shared, not copied, so don't modify it. """
+        return self.states.snapshot.state
+
+    def changed_since(self, version):
+        """ Whether the tracked object model has changed since the given snapshot version """
+        return self.states.snapshot.version != version
+
+    def value(self, key):
+        """ The current value of a template key, or of x, y, z or u """
+        state = self.states.snapshot.state
+        if key in state:
+            return state[key]
         with self.state_lock:
-            return copy.deepcopy(self.state)
+            return self.internal_state[key]
+
+    def on_change(self, key, callback):
+        """ Call callback(key, new value) whenever key changes - see ChangeWatchers """
+        self.watchers.add(key, callback)
+
+    def remove_callback(self, key, callback):
+        self.watchers.remove(key, callback)
+
+    def when(self, key, predicate = None):
+        """ A future resolving to the first value of key satisfying predicate
+        (including the current one), or to its next value if there's no predicate """
+        return self.watchers.when(key, predicate, lambda: self.value(key))
+
+    def wait_for(self, key, predicate = None, timeout = None):
+        """ Block until key satisfies predicate, or changes if there's no
+        predicate, returning its value. Raises TimeoutError on timeout. """
+        future = self.when(key, predicate)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"""Timed out waiting on {key}""")
     
     def __exit__(self, type, value, tb):
         # Signal the worker thread to terminate, and join it
@@ -0,0 +1,163 @@
+import sys
+import time
+import numpy as np
+
+# Instrumentation for a MachineConnection: when a connection is given a
+# Recorder, every patch (time, position, idle) and every G-code (type, send
+# time, reply time, and how many codes were ahead of it in the pipeline) is
+# logged into fixed size arrays. When each command started
+# moving and went idle again is worked out afterwards from the patch log, so
+# recording costs a few array writes per message.
+
+
+class Ring:
+    """ A fixed size, preallocated ring buffer of records of a numpy dtype.
+    Written by a single thread; once full, the oldest records are overwritten. """
+
+    def __init__(self, dtype, size):
+        self.data = np.zeros(size, dtype = dtype)
+        self.size = size
+        self.count = 0
+
+    def next(self):
+        """ The next record to fill in """
+        record = self.data[self.count % self.size]
+        self.count += 1
+        return record
+
+    def contents(self):
+        """ A copy of every record still held, oldest first """
+        if self.count <= self.size:
+            return self.data[:self.count].copy()
+        start = self.count % self.size
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+
+patch_dtype = np.dtype([('time', np.float64), ('xyzu', np.float32, 4), ('idle', np.bool_)])
+command_dtype = np.dtype([('type', np.int16), ('sent', np.float64), ('acked', np.float64),
+                          ('depth', np.int16), ('ready', np.float64)])
+
+
+def command_type(code):
+    """ The first word of a line of G-code - G0, M400 and so on """
+    words = code.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def first_at_or_after(indices, i, n):
+    """ For each of i, the first of the sorted indices at or after it, or n if there isn't one """
+    j = np.searchsorted(indices, i)
+    return np.append(indices, n)[j]
+
+
+class Recorder:
+    """ Logs a connection's patches and commands.
+
+    patches: number of patches to keep
+    commands: number of commands to keep """
+
+    def __init__(self, patches = 100000, commands = 10000):
+        self.patches = Ring(patch_dtype, patches)
+        self.commands = Ring(command_dtype, commands)
+        self.types = {}
+        self.last_acked = -np.inf
+
+    def patch(self, internal_state, idle):
+        """ Called with each patch, with the state lock held """
+        record = self.patches.next()
+        record['time'] = time.time()
+        record['xyzu'] = (internal_state['x'], internal_state['y'], internal_state['z'], internal_state['u'])
+        record['idle'] = idle
+
+    def command(self, code, sent, acked, depth = 0):
+        """ Called with each reply. depth is the number of codes sent before
+        this one that were still awaiting replies when it was sent - its reply
+        can't come before theirs, so it's only counted as ready to be handled
+        once it's sent and the reply ahead of it has arrived. """
+        record = self.commands.next()
+        kind = command_type(code)
+        if kind not in self.types:
+            self.types[kind] = len(self.types)
+        record['type'] = self.types[kind]
+        record['sent'] = sent
+        record['acked'] = acked
+        record['depth'] = depth
+        record['ready'] = sent if depth == 0 else max(sent, self.last_acked)
+        self.last_acked = acked
+
+    def columns(self, start_window = 1.0):
+        """ Everything recorded, as a dict of arrays. Each command also gets the
+        time the machine was first reported busy after its reply ('started'),
+        and first reported idle after that ('finished'), or NaN if that hasn't
+        been recorded. Commands that aren't followed by a busy status within
+        start_window seconds are taken not to have moved anything: 'started'
+        is NaN, and 'finished' is the reply time if the machine was idle then,
+        or the first idle status after it otherwise. """
+        patches, commands = self.patches.contents(), self.commands.contents()
+        t, idle = patches['time'], patches['idle']
+        padded = np.append(t, np.nan)
+
+        first = np.searchsorted(t, commands['acked'], side = 'right')
+        busy = first_at_or_after(np.flatnonzero(~idle), first, len(t))
+        started = padded[busy]
+        moved = started - commands['acked'] <= start_window
+        started[~moved] = np.nan
+        finished = padded[first_at_or_after(np.flatnonzero(idle), np.where(moved, busy, first), len(t))]
+        idle_then = np.append(idle, True)[first - 1] & (first > 0)
+        finished[~moved & idle_then] = commands['acked'][~moved & idle_then]
+
+        names = sorted(self.types, key = self.types.get)
+        return {'patch_time': t, 'xyzu': patches['xyzu'], 'idle': idle,
+                'command_type': commands['type'], 'command_names': np.array(names, dtype = str),
+                'sent': commands['sent'], 'acked': commands['acked'],
+                'depth': commands['depth'], 'ready': commands['ready'],
+                'started': started, 'finished': finished}
+
+    def save(self, path):
+        """ Write everything recorded to an .npz file """
+        np.savez_compressed(path, **self.columns())
+
+    def summary(self, percentiles = (50, 90, 99)):
+        return latency_summary(self.columns(), percentiles)
+
+
+def latency_summary(columns, percentiles = (50, 90, 99)):
+    """ Latency percentiles per command type, from Recorder.columns or a saved
+    .npz. Returns {type: {measure: (count, percentile values)}}, with measures:
+
+    queue: send to the reply ahead of it in the pipeline, if any - time spent
+      waiting behind earlier codes, which is 0 unless codes were pipelined
+    ack: from then to its own reply, so the handling of just this code
+    start: reply to first busy status
+    finish: send to idle again """
+
+    summary = {}
+    for i, name in enumerate(columns['command_names']):
+        mask = columns['command_type'] == i
+        sent, acked = columns['sent'][mask], columns['acked'][mask]
+        # Recordings from before pipeline positions were logged count from sending
+        ready = columns['ready'][mask] if 'ready' in columns else sent
+        measures = {'queue': ready - sent,
+                    'ack': acked - ready,
+                    'start': columns['started'][mask] - acked,
+                    'finish': columns['finished'][mask] - sent}
+        summary[str(name)] = {}
+        for measure, values in measures.items():
+            values = values[np.isfinite(values)]
+            p = np.percentile(values, percentiles) if len(values) else np.full(len(percentiles), np.nan)
+            summary[str(name)][measure] = (len(values), p)
+    return summary
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: machine_recorder.py <recording.npz>")
+        exit()
+
+    columns = dict(np.load(sys.argv[1]))
+    print(f"""{len(columns['patch_time'])} patches, {len(columns['sent'])} commands""")
+    print(f"""{'type':>8} {'measure':>8} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}""")
+    for name, measures in latency_summary(columns).items():
+        for measure, (count, p) in measures.items():
+            print(f"""{name:>8} {measure:>8} {count:6d} {1e3 * p[0]:8.1f} {1e3 * p[1]:8.1f} {1e3 * p[2]:8.1f}""")
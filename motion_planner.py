@@ -0,0 +1,290 @@
+import math
+import sys
+import time
+import numpy as np
+
+# Ordering and sequencing of multi-stop jobs. A job is a list of visits, each
+# one or more stops made back to back (a dip in a well and then a dot on a plate,
+# say), with optional precedence constraints between visits. The planner picks
+# a visit order that keeps travel short - nearest neighbour, improved by 2-opt -
+# and turns it into G0 moves that lift, travel and descend.
+
+
+class Stop:
+    """ A point to visit. The tool travels to (x, y), then down to z.
+
+    z: working height, or None to stay at the travel height (or, without a
+       clearance, at whatever height we're at)
+    safe_z: height the tool must rise to (and descend from) vertically when
+       leaving (or arriving at) this stop - for stops down inside a well, say.
+       Defaults to z, so no vertical approach is needed.
+    zone: stops sharing a zone (the same plate, say) can be hopped between at
+       their safe heights without going up to the clearance height """
+
+    def __init__(self, x, y, z = None, safe_z = None, zone = None):
+        self.x, self.y, self.z = x, y, z
+        self.safe_z = z if safe_z is None else max(safe_z, z if z is not None else safe_z)
+        self.zone = zone
+
+
+def as_visit(visit):
+    return [visit] if isinstance(visit, Stop) else list(visit)
+
+
+class Planner:
+    """ clearance: height to travel at between stops in different zones, or None
+    if there's nothing to clear and every leg can be one straight move """
+
+    def __init__(self, clearance = None):
+        self.clearance = clearance
+
+    def height(self, z):
+        """ The height a stop is left from or arrived at, NaN for unchanged """
+        if z is not None:
+            return z
+        return self.clearance if self.clearance is not None else math.nan
+
+    def leg_costs(self, exits, entries):
+        """ Matrix of travel distances from each exit stop to each entry stop """
+        ex = np.array([(s.x, s.y) for s in exits], dtype = float)
+        en = np.array([(s.x, s.y) for s in entries], dtype = float)
+        xy = np.sqrt(np.sum((ex[:, None] - en[None, :])**2, axis = 2))
+
+        # Vertical segments, with unchanged heights costing nothing
+        z_out = np.array([self.height(s.z) for s in exits])
+        safe_out = np.array([self.height(s.safe_z) for s in exits])
+        z_in = np.array([self.height(s.z) for s in entries])
+        safe_in = np.array([self.height(s.safe_z) for s in entries])
+        lift = np.nan_to_num(safe_out - z_out)[:, None]
+        drop = np.nan_to_num(safe_in - z_in)[None, :]
+        hop = np.nan_to_num(safe_in[None, :] - safe_out[:, None])
+        direct = lift + np.sqrt(xy**2 + hop**2) + drop
+
+        if self.clearance is None:
+            return direct
+        c = self.clearance
+        over = np.nan_to_num(c - z_out)[:, None] + xy + np.nan_to_num(c - z_in)[None, :]
+        zone_out = [s.zone for s in exits]
+        zone_in = [s.zone for s in entries]
+        same = np.array([[a is not None and a == b for b in zone_in] for a in zone_out], dtype = bool)
+        return np.where(same, direct, over)
+
+    def order(self, visits, after = (), start = None):
+        """ A good order to make the visits in, as a list of indices into visits.
+
+        after: pairs (i, j) meaning visit i must come before visit j
+        start: (x, y, z) the tool starts from - the first visit's entry otherwise
+
+        Raises ValueError if the constraints have a cycle. """
+
+        visits = [as_visit(v) for v in visits]
+        n = len(visits)
+        if n == 0:
+            return []
+        if start is None:
+            first = visits[0][0]
+            start = (first.x, first.y, first.z)
+        origin = Stop(*start)
+
+        # Node 0 is the start; visit i is node i + 1
+        cost = self.leg_costs([origin] + [v[-1] for v in visits], [origin] + [v[0] for v in visits])
+        before = [set() for _ in range(n + 1)]
+        for i, j in after:
+            before[j + 1].add(i + 1)
+
+        tour = nearest_neighbour(cost, before)
+        tour = two_opt(cost, tour, before)
+        return [int(node) - 1 for node in tour[1:]]
+
+    def leg(self, here, stop):
+        """ The moves taking the tool from one stop to the next, as dicts of
+        axis letter to position """
+
+        moves = []
+        if here is None:
+            # Nothing known about where we are: go straight up, over and down
+            if self.clearance is not None:
+                moves.append({'Z': self.clearance})
+            moves.append({'X': stop.x, 'Y': stop.y})
+            if stop.z is not None:
+                moves.append({'Z': stop.z})
+            return moves
+
+        direct = self.clearance is None or (here.zone is not None and here.zone == stop.zone)
+        if direct:
+            if here.z is not None and here.safe_z > here.z:
+                moves.append({'Z': here.safe_z})
+            # Over to the next stop, changing height on the way if we need to
+            travel = {'X': stop.x, 'Y': stop.y}
+            if stop.safe_z is not None:
+                travel['Z'] = stop.safe_z
+            moves.append(travel)
+            if stop.z is not None and stop.safe_z > stop.z:
+                moves.append({'Z': stop.z})
+        else:
+            if here.z is None or here.z < self.clearance:
+                moves.append({'Z': self.clearance})
+            moves.append({'X': stop.x, 'Y': stop.y})
+            if stop.z is not None:
+                moves.append({'Z': stop.z})
+
+        return moves
+
+    def moves(self, visits, order, here = None):
+        """ Every move for making the visits in the given order, as
+        (visit index, stop, moves) for each stop. here is the Stop we're starting
+        from, if known. """
+        for i in order:
+            for stop in as_visit(visits[i]):
+                yield i, stop, self.leg(here, stop)
+                here = stop
+
+    def run(self, machine, visits, order, at_stop = None):
+        """ Make the visits on a MachineConnection. Without at_stop the whole job
+        is streamed as one pipelined batch; otherwise the moves to each stop are
+        sent, and once it's been reached at_stop(visit index, stop) is called. """
+        here = Stop(*machine.xyzu()[0:3])
+        if at_stop is None:
+            lines = self.program(visits, order, here)
+            if not lines:
+                return
+            machine.gcode(lines[:-1], block = False)
+            machine.move(**last_move(self.moves(visits, order, here)))
+            return
+        for i, stop, moves in self.moves(visits, order, here):
+            if len(moves) > 1:
+                machine.gcode([move_line(m) for m in moves[:-1]], block = False)
+            machine.move(**moves[-1])
+            at_stop(i, stop)
+
+    def program(self, visits, order, here = None, dwell = None):
+        """ The whole job as G-code lines, with an optional G4 dwell (in ms) at
+        each stop """
+        lines = []
+        for _, _, moves in self.moves(visits, order, here):
+            lines += [move_line(m) for m in moves]
+            if dwell:
+                lines.append(f"""G4 P{dwell}""")
+        return lines
+
+
+def move_line(move):
+    """ A move dict as a G0 line, in the same form as MachineConnection.move_code """
+    return 'G0 ' + ' '.join(axis + str(value) for axis, value in move.items())
+
+
+def last_move(moves):
+    """ The final position of a sequence of (visit, stop, moves), as one move dict """
+    final = {}
+    for _, _, legs in moves:
+        for m in legs:
+            final.update(m)
+    return final
+
+
+def nearest_neighbour(cost, before):
+    """ Greedy tour from node 0, always moving to the cheapest node whose
+    predecessors have all been visited """
+    n = len(cost)
+    blocked = np.array([len(b) > 0 for b in before])
+    visited = np.zeros(n, dtype = bool)
+    visited[0] = True
+    tour, seen, here = [0], {0}, 0
+    for _ in range(n - 1):
+        available = ~visited & ~blocked
+        if not available.any():
+            raise ValueError("Visit ordering constraints have a cycle")
+        here = int(np.argmin(np.where(available, cost[here], np.inf)))
+        visited[here] = True
+        tour.append(here)
+        seen.add(here)
+        # Unblock anything waiting on just this node
+        for j in np.flatnonzero(blocked):
+            if here in before[j] and before[j] <= seen:
+                blocked[j] = False
+    return tour
+
+
+def respects(tour, before, i, j):
+    """ Whether reversing tour[i:j + 1] keeps every ordering constraint """
+    segment = set(tour[i:j + 1])
+    return all(not (before[node] & segment) for node in tour[i:j + 1])
+
+
+def two_opt(cost, tour, before, tolerance = 1e-9):
+    """ Improve an open tour (fixed at node 0) by reversing segments while that
+    shortens it. Costs needn't be symmetric: for each candidate reversal the
+    change in cost is found from running sums of the tour's cost walked forwards
+    and backwards, so every candidate is scored at once. """
+
+    tour = np.array(tour)
+    n = len(tour)
+    if n < 3:
+        return list(tour)
+    constrained = any(before)
+
+    while True:
+        forward = np.concatenate(([0], np.cumsum(cost[tour[:-1], tour[1:]])))
+        backward = np.concatenate(([0], np.cumsum(cost[tour[1:], tour[:-1]])))
+
+        # Reverse tour[i..j], 1 <= i < j <= n - 1
+        i = np.arange(1, n)[:, None]
+        j = np.arange(1, n)[None, :]
+        jj = np.minimum(j + 1, n - 1)
+        tail = j < n - 1
+        old = cost[tour[i - 1], tour[i]] + forward[j] - forward[i] + np.where(tail, cost[tour[j], tour[jj]], 0)
+        new = cost[tour[i - 1], tour[j]] + backward[j] - backward[i] + np.where(tail, cost[tour[i], tour[jj]], 0)
+        delta = np.where(j > i, new - old, np.inf)
+
+        # Take the best reversal allowed by the constraints
+        best = None
+        candidates = [np.argmin(delta)]
+        if constrained:
+            a, b = np.unravel_index(candidates[0], delta.shape)
+            if not respects(list(tour), before, a + 1, b + 1):
+                candidates = np.argsort(delta, axis = None)
+        for k in candidates:
+            a, b = np.unravel_index(k, delta.shape)
+            if delta[a, b] >= -tolerance:
+                break
+            if not constrained or respects(list(tour), before, a + 1, b + 1):
+                best = a + 1, b + 1
+                break
+        if best is None:
+            return list(tour)
+        a, b = best
+        tour[a:b + 1] = tour[a:b + 1][::-1].copy()
+
+
+def tour_cost(cost, tour):
+    return float(sum(cost[a, b] for a, b in zip(tour[:-1], tour[1:])))
+
+
+if __name__ == '__main__':
+
+    # Travel for a transfer job on a plate of spots, each dotted from one of a
+    # row of source wells, in the order given versus the planned order
+    spots = int(sys.argv[1]) if len(sys.argv) > 1 else 96
+    columns = {96: 12, 384: 24}.get(spots, int(math.sqrt(spots)))
+    rows = math.ceil(spots / columns)
+    spacing = 9 * 12 / columns
+
+    rng = np.random.default_rng(0)
+    wells = [Stop(150 + 20 * w, 50, 16, safe_z = 25) for w in range(3)]
+    visits = []
+    for k in range(spots):
+        dot = Stop(100 + spacing * (k % columns), 100 + spacing * (k // columns), 13.75, safe_z = 15, zone = 'plate')
+        visits.append([wells[rng.integers(len(wells))], dot])
+
+    planner = Planner(clearance = 25)
+    start = (0, 0, 25)
+    origin = Stop(*start)
+    cost = planner.leg_costs([origin] + [v[-1] for v in visits], [origin] + [v[0] for v in visits])
+
+    t = time.perf_counter()
+    order = planner.order(visits, start = start)
+    elapsed = time.perf_counter() - t
+
+    given = tour_cost(cost, range(spots + 1))
+    planned = tour_cost(cost, [0] + [i + 1 for i in order])
+    print(f"""{spots} transfers: {given:.0f} mm of travel in order, {planned:.0f} mm planned ({elapsed:.2f} s to plan)""")
@@ -4,86 +4,86 @@ import math
 import random
 import sys
 import json
+from collections import namedtuple
 
 import numpy as np
 
-from scipy.spatial import KDTree
 from machine_interface import MachineConnection
-
-def get_fresh_frame(cam, n = 5):
-    """ For some reason, we need to read a few frames in order to get a fresh one. 
-    This is very annoying. """
-    frame = None
-    for j in range(5):
-        ret, frame = cam.read()
-    return frame
-
-def circle_settings(calibration, diameter, spacing, tol = 0.2):
-    lo, hi = calibration["scaling_range"]
-    dist = int((1 - tol) * spacing / lo)
+from frame_source import CaptureThread, OpenCVCamera
+from camera_cal import CameraCal
+from circle_finder import CircleFinder
+from plate_lattice import fit_lattice
+
+def get_fresh_frame(cam):
+    """ OpenCV queues up a few frames, so a plain read returns a stale one. cam
+    is a CaptureThread, which keeps that queue drained - so we just wait for the
+    first frame captured once the machine is idle. It's transposed, as the
+    frames camera_cal.json was fitted on were. """
+    return np.ascontiguousarray(np.transpose(cam.after_idle()[0], axes = (1,0,2)))
+
+def frame_shape(camera):
+    """ Shape of the frames get_fresh_frame gives from a camera """
+    rows, columns, channels = camera.shape
+    return (columns, rows, channels)
+
+def make_finder(calibration, diameter, spacing, tol = 0.2, shape = None):
+    """ A CircleFinder for circles of the given diameter and spacing, in mm, in
+    frames of the given shape (the calibration's own by default) """
+    lo, hi = calibration.pixel_scale(shape)
     radius = 0.5 * diameter
-    return dist, int((1 - tol) * radius / lo), int((1 + tol) * radius / hi)
-
-def find_all_circles(frame, settings, gain = 2.2):
-    md,minr,maxr = settings
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    y,x,_ = frame.shape
-    return cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, gain, 
-                            minDist = md, minRadius = minr, maxRadius = maxr)[0][:,0:2] - np.array([x/2,y/2])
-
-
-def estimate_basis(points):
-    # Find all of the angles of vectors between nearest neighbors,
-    # with the quadrant quotiented out
-    theta, n = 0,0
-    for i,j in KDTree(realspace).query_pairs(0.9 * math.sqrt(2) * plate_description['spacing']):
-        v = realspace[i] - realspace[j]
-        # Expand the angle by 4x, and wrap back into the unit circle
-        theta += np.angle((v[0] + 1j * v[1])**4)
-        n += 1
-    theta /= 4 * n
-    phi = theta + math.pi / 2
-    return np.array([np.cos(theta),np.sin(theta)]),np.array([np.cos(phi),np.sin(phi)])
-
-def circle_callback(cam, settings, transform):
-
-    def f():
-        return find_all_circles(get_fresh_frame(cam), settings) @ transform.T
-    return f
-
-def center_nearest_circle(circles, machine, iterations = 3):
+    return CircleFinder((1 - tol) * radius / hi, (1 + tol) * radius / lo, (1 - tol) * spacing / hi)
 
-    for _ in range(iterations):
-        distance, point = 100000, None
-        for c in circles():
-            d = c.dot(c)
-            if d < distance:
-                distance = d
-                point = c
-                
-        print("Centering ", point)
-        m.move(m.xyzu()[0:2] - point)
 
+def circle_callback(cam, finder, cal, region = None):
+    """ Returns a function giving the real space offsets of the circles in a
+    fresh frame - only those in the real space box region, if it's given """
 
-def follow_vector(circles, vector, machine):
+    def f():
+        frame = get_fresh_frame(cam)
+        roi = None if region is None else cal.roi(region, shape = frame.shape)
+        return cal.px_to_real(finder(frame, roi = roi)['center'], shape = frame.shape)
+    return f
 
+# Result of centering: where we ended up, how far off the circle was when we
+# last looked (None if no circle was seen), moves made and seconds taken
+Centered = namedtuple('Centered', ['position', 'residual', 'iterations', 'time'])
+
+def servo_gain(cal):
+    """ Fraction of each measured offset to move by. The calibration's scale
+    varies between lo and hi mm per pixel across the frame, so a measured
+    offset can be out by a factor between lo / hi and hi / lo - this gain
+    minimizes the worst case error left after a move. """
+    lo, hi = cal.scale
+    return 2 / (lo / hi + hi / lo)
+
+def center_nearest_circle(circles, machine, cal, iterations = 3, tolerance = None, shape = None):
+    """ Center the camera on the circle nearest the middle of the frame, moving
+    until it's within tolerance mm (by default half a pixel, in frames of the
+    given shape), or for at most iterations moves. """
+    if tolerance is None:
+        tolerance = 0.5 * cal.pixel_scale(shape)[1]
+    gain = servo_gain(cal)
+
+    start = time.time()
+    moves, residual = 0, None
     while True:
-    
         centers = circles()
-        best = np.argmax(centers.dot(vector))
-        closest = np.argmin(np.sum(centers**2, axis = 1))
-
-        
-        if best != closest:
-            point = m.xyzu()[0:2] - centers[best]
-            print("Moving to ", point)
-            m.move(point)
-        else:
+        if len(centers) == 0:
+            residual = None
             break
+        nearest = centers[np.argmin(np.einsum('ij,ij->i', centers, centers))]
+        residual = math.sqrt(nearest.dot(nearest))
+        if residual <= tolerance or moves == iterations:
+            break
+        machine.move(machine.xyzu()[0:2] - gain * nearest)
+        moves += 1
 
-    center_nearest_circle(circles, machine, iterations = 1)
-    return m.xyzu()[0:2]
-
+    result = Centered(machine.xyzu()[0:2], residual, moves, time.time() - start)
+    if residual is None:
+        print(f"""Centering: no circle found after {moves} moves""")
+    else:
+        print(f"""Centered to {1e3 * residual:.1f} um in {moves} moves, {result.time:.2f} s""")
+    return result
 
 
 plate_description = {"spacing" : 4.5, 
@@ -102,14 +102,21 @@ plate_description = {"spacing" : 4.5,
 def in_band(dim, band):
     return dim > band[0] and dim < band[1]
 
-def find_fiducals(frame, desc, cal, transform, vects, tol = 0.2):
+def find_fiducals(frame, desc, cal, vects, tol = 0.2):
     fid = desc['fiducials']
-    settings = circle_settings(cal,fid['diameter'], fid['distance'])
+    finder = make_finder(cal,fid['diameter'], fid['distance'], shape = frame.shape)
     lb,sb = fid['long_spacing'], fid['short_spacing']
     lv,sv = vects
+
+    # Only look where the fiducials can be: the band along the long axis
+    # they sit in, padded by their diameter
+    corners = np.array([a * lb[1] * lv + b * sb[1] * sv for a in [-1,1] for b in [-1,1]])
+    lo, hi = corners.min(axis = 0) - fid['diameter'], corners.max(axis = 0) + fid['diameter']
+    roi = cal.roi((lo[0], lo[1], hi[0], hi[1]), shape = frame.shape)
+
     n = 0
     mean = np.zeros(2)
-    for x in find_all_circles(frame, settings, gain = 3.0) @ transform.T:
+    for x in cal.px_to_real(finder(frame, roi = roi)['center'], shape = frame.shape):
         if in_band(abs(sv.dot(x)), sb) and in_band(abs(lv.dot(x)),lb):
             n += 1
             mean += x
@@ -121,41 +128,62 @@ def write_with_cross(fp, img):
     
     img = img.copy()
 
-    img[:, 320,:] = 255, 0, 255
-    img[240, :,:] = 255, 0, 255
+    rows, columns, _ = img.shape
+    img[:, columns // 2,:] = 255, 0, 255
+    img[rows // 2, :,:] = 255, 0, 255
 
     cv2.imwrite(fp, img)
 
 
-with open("camera_cal.json") as f:
-    cal = json.loads(f.read())
-
-transform = np.array(cal['transform'])
-
-vision_settings = circle_settings(cal, plate_description['diameter'], plate_description['spacing'])
+cal = CameraCal.load("camera_cal.json")
 
 print("Establishing video connection")
-cam = cv2.VideoCapture(0)
+camera = OpenCVCamera(0)
+shape = frame_shape(camera)
+
+well_finder = make_finder(cal, plate_description['diameter'], plate_description['spacing'], shape = shape)
 
 print("Initializing machine connection")
-with MachineConnection('/var/run/dsf/dcs.sock') as m:
+with MachineConnection('/var/run/dsf/dcs.sock') as m, \
+     CaptureThread(camera, machine = m) as cam:
 
     
-    m.move(150, 150 , cal['bed_focus'] + plate_description['thickness'])
-
+    m.move(150, 150 , cal.bed_focus + plate_description['thickness'])
 
-    circles = circle_callback(cam, vision_settings, transform)
 
-    start =  m.xyzu()[0:2]
-    realspace = circles() + m.xyzu()[0:2]
-    u,v = estimate_basis(realspace)
+    circles = circle_callback(cam, well_finder, cal)
+    # Centering only needs the circle nearest the middle of the frame
+    spacing = plate_description['spacing']
+    near = circle_callback(cam, well_finder, cal, region = (-spacing, -spacing, spacing, spacing))
 
-    
-    first_corner = follow_vector(circles, u + v, m)
+    # Fit the plate's wells from one frame, or a few if it doesn't fit in one -
+    # then look either side of what we've seen along any axis that's short.
+    # A circle at offset c in the frame is under the camera at position - c.
+    points = m.xyzu()[0:2] - circles()
+    lattice = fit_lattice(points, plate_description['spacing'], plate_description['grid'])
+    for _ in range(2):
+        if lattice.complete:
+            break
+        seen = lattice.indices[lattice.inliers]
+        middle = 0.5 * (seen.min(axis = 0) + seen.max(axis = 0))
+        for axis in [0,1]:
+            for end in [seen[:,axis].min(), seen[:,axis].max()]:
+                index = middle.copy()
+                index[axis] = end
+                m.move(lattice.predict(index))
+                points = np.concatenate([points, m.xyzu()[0:2] - circles()])
+        lattice = fit_lattice(points, plate_description['spacing'], plate_description['grid'])
+    print(f"""Fitted {lattice.inliers.sum()} wells, residual {lattice.residual:.3f} mm""")
+
+    u,v = lattice.axes()
+    wells = lattice.wells().reshape(-1,2)
+
+    first_corner = wells[np.argmax(wells.dot(u + v))]
+    m.move(first_corner)
     write_with_cross("fiducials/corner1.png",get_fresh_frame(cam))
 
-    m.move(start)
-    second_corner = follow_vector(circles, 0 - u - v, m)
+    second_corner = wells[np.argmax(wells.dot(0 - u - v))]
+    m.move(second_corner)
     write_with_cross("fiducials/corner2.png",get_fresh_frame(cam))
 
     fiducials = None
@@ -174,10 +202,10 @@ with MachineConnection('/var/run/dsf/dcs.sock') as m:
 
             print("Checking for fiducials at ", reference_point + sign * offset)
             m.move(reference_point + sign * offset)
-            f = find_fiducals(get_fresh_frame(cam), plate_description, cal, transform, (lv,sv))
+            f = find_fiducals(get_fresh_frame(cam), plate_description, cal, (lv,sv))
             if f is not None:
                 print("Found fiducials")
-                fiducials = f + m.xyzu()[0:2], (a,b), sv, lv
+                fiducials = m.xyzu()[0:2] - f, (a,b), sv, lv
                 break
 
 
@@ -203,19 +231,16 @@ with MachineConnection('/var/run/dsf/dcs.sock') as m:
         origin = top
         print("Centering on upper right")
         m.move(bottom + short * short.dot(top - bottom))
-        center_nearest_circle(circles, m, iterations = 2)
-        upper_right = m.xyzu()[0:2]
+        upper_right = center_nearest_circle(near, m, cal, shape = shape).position
 
         print("Centering on lower left")
         m.move(bottom + longv * longv.dot(top - bottom))
-        center_nearest_circle(circles, m, iterations = 2)
-        upper_right = m.xyzu()[0:2]
+        lower_left = center_nearest_circle(near, m, cal, shape = shape).position
         
     else:
         print("Centering on origin")
         m.move(bottom + short * short.dot(top - bottom))
-        center_nearest_circle(circles, m, iterations = 2)
-        origin = m.xyzu()[0:2]
+        origin = center_nearest_circle(near, m, cal, shape = shape).position
         lower_left = bottom
         upper_right = top
 
@@ -231,6 +256,6 @@ with MachineConnection('/var/run/dsf/dcs.sock') as m:
     with open("orientation.json", "w") as f:
         json.dump(blob, f)
 
-cam.release()
+camera.close()
 
     
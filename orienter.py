@@ -7,23 +7,8 @@ import math
 import json
 import sys
 
-
-class CameraCal:
-    def __init__(self, blob):
-        self.blob = blob
-        self.matrix = np.array(self.blob['transform'])
-        self.size = self.blob['resolution']
-        self.scale = self.blob['scale']
-        
-    def px_to_real(self, x, y):
-        x = (x / self.size[1]) - 0.5
-        y = (y / self.size[0]) - 0.5
-     
-        return self.matrix.T @ np.array([x**2,y**2,x * y, x, y])
-    
-    def distance_to_px_range(self, distance, slop = 0.1):
-        return int((1 - slop) * distance / self.scale[1]), int((1 + slop) * distance / self.scale[0])
-
+from camera_cal import CameraCal
+from photo_stream import PhotoStream, remote_grab
 
 
 class DotManager:
@@ -66,9 +51,7 @@ def solve_from_points(camera, points, origin, grid = (12, 7)):
         print(f"Need exactly 4 points - {n} provided. Failing.")
         exit()
 
-    packed = np.empty((4,2))
-    for i,(x,y,_) in enumerate(points):
-        packed[i,:] = camera.px_to_real(x,y)
+    packed = camera.px_to_real(np.array([(x, y) for x,y,_ in points]))
     # Setup a least squares system to find the spacing and rotation of the plate
     mu = np.mean(packed, axis = 0)
     n,m = (grid[0] - 1) / 2, (grid[1] - 1) / 2
@@ -91,41 +74,36 @@ if len(sys.argv) < 3:
     exit()
 
 directory = sys.argv[1]
-locations = ' '.join(sys.argv[2:])
+locations = sys.argv[2:]
 
 
 print("Taking photographs")
 
-os.system(f"""ssh pi@jubilee.local sudo python3 colony/grab_frame.py {locations} > {directory}.tar""")
-print("Extracting photographs")
+# Plates are worked on as their photos arrive, while the rest are still
+# being taken
 os.system(f"""rm -rf {directory}""")
-os.system(f"""mkdir {directory}""")
-os.system(f"""tar -xf {directory}.tar -C {directory}""")
-os.system(f"""rm {directory}.tar """)
 
-
-with open(os.path.join(directory,"meta.json"),"r") as f:
-    meta = json.load(f)
-
-cal = CameraCal(meta['cal'])
+cal = None
 plates = {}
-n = 0
 
-for key, origin in meta['photos'].items():
+with PhotoStream(remote_grab(locations), directory) as photos:
+    for key, origin, img in photos:
 
+        if cal is None:
+            cal = CameraCal(photos.cal)
+        # Frames are decoded as BGR, matplotlib wants RGB
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    img = cv2.imread(os.path.join(directory, key + ".png"))
-
-    fig, ax = plt.subplots()
-    ax.imshow(img)
+        fig, ax = plt.subplots()
+        ax.imshow(img)
     
-    dots = DotManager(ax)
-    cid = fig.canvas.mpl_connect('button_press_event', dots.handle_event)    
-    plt.show()
+        dots = DotManager(ax)
+        cid = fig.canvas.mpl_connect('button_press_event', dots.handle_event)    
+        plt.show()
     
-    plates['key'] = solve_from_points(cal,dots.points, meta['photos'][key])
+        plates[key] = solve_from_points(cal,dots.points, origin)
     
-
+meta = photos.meta
 meta['plates'] = plates
 
 with open(os.path.join(directory, "meta.json"),"w") as f:
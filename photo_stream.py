@@ -0,0 +1,195 @@
+import json
+import os
+import queue
+import subprocess
+import tarfile
+import threading
+import time
+import cv2
+import numpy as np
+
+# Photos are streamed from grab_frame.py as a tar archive written to stdout a
+# member at a time, so the far end can start on the first plate while the
+# rest are still being photographed. The archive holds, in order:
+#
+# cal.json       the camera calibration
+# <n>.json       for each photo as soon as it's encoded, its [x, y, z] target...
+# <n>.png        ...and then the frame itself
+# meta.json      at the end, {'cal': ..., 'photos': {n: [x, y, z]}}
+#
+# Extracted, that's the same directory layout grab_frame.py has always written
+# (and RecordedCamera reads) - plus the per photo files. It's still a plain tar,
+# so it can be saved and unpacked with tar -xf as well.
+
+
+class TarWriter:
+    """ Writes a tar archive to a binary stream one member at a time, flushing
+    each member out in full as it's added. (tarfile's own stream mode keeps the
+    last block of a member back until the next one arrives.) """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.written += len(data)
+
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self.write(info.tobuf(tarfile.USTAR_FORMAT))
+        self.write(data)
+        self.write(bytes(-len(data) % tarfile.BLOCKSIZE))
+        self.stream.flush()
+
+    def close(self):
+        # Two empty blocks end the archive, which is padded to a whole record
+        self.write(bytes(2 * tarfile.BLOCKSIZE))
+        self.write(bytes(-self.written % tarfile.RECORDSIZE))
+        self.stream.flush()
+
+
+def encode_loop(encoder):
+
+    while True:
+        item = encoder.queue.get()
+        if item is None:
+            return
+        name, frame, meta = item
+        try:
+            ok, data = cv2.imencode(encoder.extension, frame)
+            if not ok:
+                raise RuntimeError("Couldn't encode frame " + name)
+            encoder.writer.add(name + ".json", json.dumps(meta).encode())
+            encoder.writer.add(name + encoder.extension, data.tobytes())
+        except Exception as e:
+            encoder.error = e
+            return
+
+
+class FrameEncoder:
+    """ Encodes frames and adds them to a TarWriter on its own thread, so the
+    machine can be moving to the next photo meanwhile.
+
+    size: number of frames that can be waiting to be encoded before put blocks """
+
+    def __init__(self, writer, extension = ".png", size = 2):
+        self.writer = writer
+        self.extension = extension
+        self.queue = queue.Queue(maxsize = size)
+        self.error = None
+        self.worker = None
+
+    def __enter__(self):
+        self.worker = threading.Thread(target = encode_loop, args = (self,), daemon = True)
+        self.worker.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.queue.put(None)
+        self.worker.join()
+        if self.error is not None and type is None:
+            raise self.error
+
+    def put(self, name, frame, meta):
+        """ Queue a frame (which is copied) to be written as name, with its meta """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((str(name), np.array(frame), meta))
+
+
+def read_exactly(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError("Photo stream ended part way through")
+    return data
+
+
+def read_members(f):
+    """ (name, data) for each member of a TarWriter archive, read straight off
+    a pipe. Each is given as soon as its last byte arrives - tarfile's stream
+    reader reads whole 10 KiB records, so it would wait for the next member. """
+    while True:
+        header = read_exactly(f, tarfile.BLOCKSIZE)
+        if header == bytes(tarfile.BLOCKSIZE):
+            return
+        info = tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape")
+        data = read_exactly(f, info.size)
+        read_exactly(f, -info.size % tarfile.BLOCKSIZE)
+        yield info.name, data
+
+
+def read_loop(stream):
+
+    try:
+        pending = {}
+        for name, data in read_members(stream.process.stdout):
+            name = os.path.basename(name)
+            with open(os.path.join(stream.directory, name), "wb") as f:
+                f.write(data)
+
+            key, extension = os.path.splitext(name)
+            if name == "cal.json":
+                stream.cal = json.loads(data)
+            elif name == "meta.json":
+                stream.meta = json.loads(data)
+            elif extension == ".json":
+                pending[key] = json.loads(data)
+            elif key in pending:
+                image = cv2.imdecode(np.frombuffer(data, dtype = np.uint8), cv2.IMREAD_COLOR)
+                stream.queue.put((key, pending.pop(key), image))
+        # Drain the end of archive padding
+        stream.process.stdout.read()
+        if stream.process.wait() != 0:
+            raise RuntimeError(f"""Photo capture failed with exit status {stream.process.returncode}""")
+    except Exception as e:
+        stream.queue.put(e)
+    stream.queue.put(None)
+
+
+class PhotoStream:
+    """ Runs a command streaming photos (grab_frame.py, usually over ssh),
+    unpacking them into directory as they arrive. Iterating gives
+    (number, [x, y, z], image) for each photo, as soon as it's arrived -
+    the stream keeps being read in the meantime, so the capture is never held
+    up by whatever's done with each photo.
+
+    cal: the calibration blob, once the first photo has arrived
+    meta: the full meta.json blob, once iteration has finished """
+
+    def __init__(self, command, directory):
+        self.command = command
+        self.directory = directory
+        self.cal = None
+        self.meta = None
+        self.queue = queue.Queue()
+        self.process = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok = True)
+        self.process = subprocess.Popen(self.command, stdout = subprocess.PIPE)
+        self.worker = threading.Thread(target = read_loop, args = (self,), daemon = True)
+        self.worker.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self.process.poll() is None and type is not None:
+            self.process.kill()
+        self.worker.join()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def remote_grab(locations, host = "pi@jubilee.local"):
+    """ The command to take photos at locations (x,y,z strings) on the machine """
+    return ["ssh", host, "sudo", "python3", "colony/grab_frame.py"] + list(locations)
@@ -7,34 +7,10 @@ import math
 import json
 import sys
 
+from camera_cal import CameraCal
+from photo_stream import PhotoStream, remote_grab
 
-#    def px_to_real(self, x, y)
-#        x = (x / self.size[1]) - 0.5
-#        y = (y / self.size[0]) - 0.5
-#        return self.matrix.T @ np.array([x**2,y**2,x * y, x, y])   
-#    def distance_to_px_range(self, distance, slop = 0.1):
-#        return int((1 - slop) * distance / self.scale[1]), int((1 + slop) * distance / self.scale[0])
 
-
-
-class CameraCal:
-    def __init__(self, blob):
-        self.blob = blob
-        self.matrix = np.array(self.blob['transform'])
-        self.size = self.blob['resolution']
-        self.scale = self.blob['scale']
-        
-    def px_to_real(self, x, y):
-        x = (x / self.size[1]) - 0.5
-        y = (y / self.size[0]) - 0.5
-     
-        return self.matrix.T @ np.array([x**2,y**2,x * y, x, y])
-    
-    def distance_to_px_range(self, distance, slop = 0.1):
-        return int((1 - slop) * distance / self.scale[1]), int((1 + slop) * distance / self.scale[0])
-
-
-    
 class DotManager:
 
     def __init__(self, ax, radius = 10):
@@ -71,7 +47,7 @@ class DotManager:
 def annotate_image(image, points, path, starting_number = 0, radius = 20):
 
     fig, ax = plt.subplots()
-    ax.imshow(img)
+    ax.imshow(image)
 
     for i,(x,y,_) in enumerate(points):
         ax.text(x + radius, y, str(i + starting_number), c = 'm')
@@ -85,10 +61,12 @@ def annotate_image(image, points, path, starting_number = 0, radius = 20):
 def sample_records(points, camera_cal, photo_origin, plate_number = 0, starting_number = 0):
 
     origin = np.array(photo_origin)
+    if not points:
+        return
+    real = camera_cal.px_to_real(np.array([(x, y) for x,y,_ in points]))
     
-    for i,(x,y,_) in enumerate(points):
+    for i,((x,y,_),(rx,ry)) in enumerate(zip(points, real)):
 
-        rx,ry = camera_cal.px_to_real(x,y)
         n = starting_number + i
         blob = {'plate' : plate_number, 'number' : n,
                 'px': x, 'py' : y, 'origin' : photo_origin,
@@ -106,42 +84,36 @@ if len(sys.argv) < 3:
     exit()
 
 directory = sys.argv[1]
-locations = ' '.join(sys.argv[2:])
+locations = sys.argv[2:]
 
+# Plates are worked on as their photos arrive, while the rest are still
+# being taken
 print("Taking photographs")
-
-os.system(f"""ssh pi@jubilee.local sudo python3 colony/grab_frame.py {locations} > {directory}.tar""")
-print("Extracting photographs")
 os.system(f"""rm -rf {directory}""")
-os.system(f"""mkdir {directory}""")
-os.system(f"""tar -xf {directory}.tar -C {directory}""")
-os.system(f"""rm {directory}.tar """)
-
-# unpack the photos
 
-with open(os.path.join(directory,"meta.json"),"r") as f:
-    meta = json.load(f)
-
-cal = CameraCal(meta['cal'])
+cal = None
 samples = {}
-n = 0
-
-for key, origin in meta['photos'].items():
 
+with PhotoStream(remote_grab(locations), directory) as photos:
+    for key, origin, img in photos:
 
-    img = cv2.imread(os.path.join(directory, key + ".png"))
+        if cal is None:
+            cal = CameraCal(photos.cal)
+        # Frames are decoded as BGR, matplotlib wants RGB
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    fig, ax = plt.subplots()
-    ax.imshow(img)
-    dots = DotManager(ax)
-    cid = fig.canvas.mpl_connect('button_press_event', dots.handle_event)    
-    plt.show()
+        fig, ax = plt.subplots()
+        ax.imshow(img)
+        dots = DotManager(ax)
+        cid = fig.canvas.mpl_connect('button_press_event', dots.handle_event)    
+        plt.show()
 
     
-    annotate_image(img, dots.points,os.path.join(directory, f"""samples_{key}.pdf"""), starting_number = len(samples))
-    for i,blob in sample_records(dots.points, cal, origin, int(key), len(samples)):
-        samples[i] = blob
+        annotate_image(img, dots.points,os.path.join(directory, f"""samples_{key}.pdf"""), starting_number = len(samples))
+        for i,blob in sample_records(dots.points, cal, origin, int(key), len(samples)):
+            samples[i] = blob
 
+meta = photos.meta
 meta['samples'] = samples
 
 with open(os.path.join(directory, "meta.json"),"w") as f:
@@ -0,0 +1,222 @@
+import math
+import sys
+import numpy as np
+
+from scipy.spatial import KDTree
+
+# Locating a plate's wells from circle detections. The wells form a regular
+# grid, so instead of walking the machine from well to well to find the edges
+# of the plate, a lattice - a first well and a step along each axis - is fitted
+# to every detection at once. Detections are in real space (mm, machine XY),
+# and can come from several frames taken at different machine positions.
+
+
+def estimate_basis(points, spacing = None):
+    """ Orientation and spacing of a square grid of points. Returns unit vectors
+    along its two axes, the spacing, and the residual - the circular standard
+    deviation, in radians, of the neighbour directions about those axes.
+
+    spacing: the expected spacing, if known, to pick out neighbours by.
+      Otherwise it's taken to be the median nearest neighbour distance. """
+
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    if len(points) < 2:
+        raise ValueError("Too few points to estimate a grid basis")
+
+    # Neighbours are the pairs about one spacing apart - in a square grid,
+    # the ones along its axes, as the diagonals are root 2 further
+    tree = KDTree(points)
+    if spacing is None:
+        spacing = np.median(tree.query(points, k = 2)[0][:, 1])
+    pairs = tree.query_pairs(1.2 * spacing, output_type = 'ndarray')
+    v = points[pairs[:, 1]] - points[pairs[:, 0]]
+    length = np.hypot(v[:, 0], v[:, 1])
+    near = length > 0.7 * spacing
+    if not near.any():
+        raise ValueError("No grid neighbours found")
+    v, length = v[near], length[near]
+
+    # Raising each direction to the 4th power makes all four axis directions
+    # the same; average those on the unit circle, then undo the power
+    z = (v[:, 0] + 1j * v[:, 1]) / length
+    mean = np.mean(z**4)
+    theta = np.angle(mean) / 4
+    residual = math.sqrt(-2 * math.log(min(abs(mean), 1.0))) / 4 if abs(mean) > 0 else math.pi / 4
+
+    # The spacing from the neighbours' distances along the axes
+    u = np.array([math.cos(theta), math.sin(theta)])
+    along = np.abs(v @ np.stack([u, [-u[1], u[0]]], axis = 1))
+    spacing = float(np.median(np.max(along, axis = 1)))
+    return u, np.array([-u[1], u[0]]), spacing, residual
+
+
+def lattice_coordinates(points, origin, a, b):
+    """ Fractional (i, j) lattice coordinates of points, where (i, j) is at
+    origin + i * a + j * b. origin can also be K x 2, giving K x N x 2. """
+    steps = np.stack([a, b], axis = 1)
+    return (points - np.asarray(origin)[..., None, :]) @ np.linalg.inv(steps).T
+
+
+def offsets(coordinates, a, b):
+    """ Distances of points from their nearest lattice sites, given their lattice coordinates """
+    fraction = coordinates - np.rint(coordinates)
+    return np.hypot(*np.moveaxis(fraction @ np.stack([a, b]), -1, 0))
+
+
+def plate_window(indices, inliers, shape):
+    """ Where the plate is among the lattice indices of inlying detections: the
+    placement of a (long, short) shape window, either way round, holding the
+    most of them. Returns the window's lowest index, whether the long axis is
+    the second index, and which detections are inside. Where the detections
+    don't span the plate, the window starts at the first of them. """
+    low = indices[inliers].min(axis = 0)
+    span = indices[inliers].max(axis = 0) - low + 1
+    counts = np.zeros(span, dtype = int)
+    np.add.at(counts, tuple((indices[inliers] - low).T), 1)
+    table = np.pad(counts.cumsum(axis = 0).cumsum(axis = 1), ((1, 0), (1, 0)))
+
+    best = None
+    for swap, (w, h) in [(False, shape), (True, shape[::-1])]:
+        w, h = min(w, span[0]), min(h, span[1])
+        # Inliers in every placement of the window, from the summed area table
+        held = table[w:, h:] - table[:-w or None, h:] - table[w:, :-h or None] + table[:-w or None, :-h or None]
+        at = np.unravel_index(np.argmax(held), held.shape)
+        # Ties go to the long axis along the longer run of detections
+        score = (held[at], span[1] > span[0] if swap else span[0] >= span[1])
+        if best is None or score > best[0]:
+            best = score, swap, low + np.array(at), (w, h)
+
+    _, swap, start, size = best
+    inside = np.all((indices >= start) & (indices < start + np.array(size)), axis = 1)
+    return start, swap, inside
+
+
+class Lattice:
+    """ A fitted plate: well (i, j) is at origin + i * a + j * b, for i along
+    the plate's long axis and j along its short one.
+
+    shape: number of wells along the (long, short) axes
+    points, indices, inliers: the detections fitted to, the well each is
+      nearest, and whether it was close enough to count
+    residual: RMS distance of the inliers from their wells
+    complete: whether the inliers span the whole plate. Otherwise where the
+      plate's edges are is a guess, and so are the indices. """
+
+    def __init__(self, origin, a, b, shape, points, indices, inliers, residual, complete):
+        self.origin, self.a, self.b = origin, a, b
+        self.shape = shape
+        self.points, self.indices, self.inliers = points, indices, inliers
+        self.residual = residual
+        self.complete = complete
+
+    def predict(self, indices):
+        """ Centers of the wells at an array of (i, j) """
+        indices = np.asarray(indices, dtype = float)
+        return self.origin + indices[..., 0:1] * self.a + indices[..., 1:2] * self.b
+
+    def wells(self):
+        """ Every well center, as a (long, short, 2) array """
+        i, j = np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), indexing = 'ij')
+        return self.predict(np.stack([i, j], axis = 2))
+
+    def corners(self):
+        """ Centers of the wells at (0, 0), (long - 1, 0), (0, short - 1) and (long - 1, short - 1) """
+        n, m = self.shape[0] - 1, self.shape[1] - 1
+        return self.predict([[0, 0], [n, 0], [0, m], [n, m]])
+
+    def axes(self):
+        """ Unit vectors along the long and short axes """
+        return self.a / np.linalg.norm(self.a), self.b / np.linalg.norm(self.b)
+
+
+def fit_lattice(points, spacing, grid, tolerance = 0.25, trials = 200, refinements = 3, rng = None):
+    """ Fit a Lattice to circle centers in real space, ignoring stray
+    detections. The grid's orientation comes from estimate_basis; its phase by
+    RANSAC, trying detections as a well center and keeping the one with the
+    most others near a lattice site; and then the first well and both steps
+    are refined by least squares over those inliers.
+
+    spacing: nominal well spacing
+    grid: number of wells along each axis of the plate, in either order
+    tolerance: how far from a lattice site a detection can be, as a fraction of spacing
+    trials: largest number of detections to try as the phase
+
+    Raises ValueError if there aren't enough detections to fit, or they're
+    all in one row. """
+
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    if len(points) < 3:
+        raise ValueError("Too few circles to fit a lattice")
+    u, v, spacing, _ = estimate_basis(points, spacing)
+    a, b = spacing * u, spacing * v
+    limit = tolerance * spacing
+
+    # Score every candidate at once: lattice coordinates relative to each one
+    rng = np.random.default_rng() if rng is None else rng
+    candidates = np.arange(len(points)) if len(points) <= trials else rng.choice(len(points), trials, replace = False)
+    off = offsets(lattice_coordinates(points, points[candidates], a, b), a, b)
+    near = off < limit
+    score = near.sum(axis = 1) - np.where(near, off, 0).sum(axis = 1) / (limit * len(points))
+    origin = points[candidates[np.argmax(score)]]
+
+    shape = (max(grid), min(grid))
+    keep = np.ones(len(points), dtype = bool)
+    for _ in range(refinements):
+        coordinates = lattice_coordinates(points, origin, a, b)
+        indices = np.rint(coordinates).astype(int)
+        inliers = (offsets(coordinates, a, b) < limit) & keep
+        if inliers.sum() < 3:
+            raise ValueError("Too few circles on the lattice")
+        # Leave out anything off the edge of the plate
+        low, swap, inside = plate_window(indices, inliers, shape)
+        inliers &= inside
+        if inliers.sum() < 3:
+            raise ValueError("Too few circles on the lattice")
+        keep = inside
+        A = np.hstack([np.ones((inliers.sum(), 1)), indices[inliers]])
+        if np.linalg.matrix_rank(A) < 3:
+            raise ValueError("Circles on the lattice are all in one line")
+        origin, a, b = np.linalg.lstsq(A, points[inliers], rcond = None)[0]
+
+    coordinates = lattice_coordinates(points, origin, a, b)
+    indices = np.rint(coordinates).astype(int)
+    off = offsets(coordinates, a, b)
+    inliers = (off < limit) & keep
+    low, swap, inside = plate_window(indices, inliers, shape)
+    inliers &= inside
+
+    # Put the long axis first, and number wells from the plate's first corner
+    if swap:
+        a, b = b, a
+        indices, low = indices[:, ::-1], low[::-1]
+    origin = origin + low[0] * a + low[1] * b
+    indices = indices - low
+
+    residual = math.sqrt(np.mean(off[inliers]**2))
+    span = indices[inliers].max(axis = 0) - indices[inliers].min(axis = 0) + 1
+    complete = span[0] == shape[0] and span[1] == shape[1]
+    return Lattice(origin, a, b, shape, points, indices, inliers, residual, complete)
+
+
+if __name__ == '__main__':
+
+    # Fit a synthetic plate: a rotated, slightly scaled 12 x 7 grid seen with
+    # detection noise, a few wells missed and a few stray detections
+    rng = np.random.default_rng(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    spacing, grid = 4.5, [7, 12]
+    angle = rng.uniform(-0.2, 0.2)
+    a = 1.01 * spacing * np.array([math.cos(angle), math.sin(angle)])
+    b = 0.99 * spacing * np.array([-math.sin(angle), math.cos(angle)])
+    origin = np.array([140.0, 135.0])
+    i, j = np.meshgrid(np.arange(12), np.arange(7), indexing = 'ij')
+    truth = origin + i[..., None] * a + j[..., None] * b
+    seen = truth.reshape(-1, 2)[rng.random(84) > 0.1] + rng.normal(0, 0.02, (1, 2))
+    seen = seen + rng.normal(0, 0.02, seen.shape)
+    stray = origin + rng.uniform(-5, 55, (5, 2))
+    points = np.concatenate([seen, stray])
+
+    lattice = fit_lattice(points, spacing, grid)
+    # The fit can number the wells from any corner, so match each to the nearest true one
+    error, _ = KDTree(truth.reshape(-1, 2)).query(lattice.wells().reshape(-1, 2))
+    print(f"""{len(points)} detections, {lattice.inliers.sum()} on the lattice, complete: {lattice.complete}""")
+    print(f"""residual {lattice.residual:.3f} mm, worst predicted well error {error.max():.3f} mm""")
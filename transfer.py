@@ -16,61 +16,203 @@
 
 # well 3
 #G0 Y50 X190
-import time
-import math
-import random
+import hashlib
+import os
 import sys
 import json
 import numpy as np
 from machine_interface import MachineConnection
-
-
-
-with open("orientation.json") as f:
-    orientation = json.loads(f.read())
-
-origin = np.array(orientation['origin'])
-ll = np.array(orientation['ll'])
-ur = np.array(orientation['ur'])
-
-dx = (ur - origin) / 11
-dy = (ll - origin) / 6
-
-with open("camera_cal.json") as f:
-    cal = json.loads(f.read())
-
-z_clearance = 25
-z_dip = 16
-z_transfer = 13.75
-
-offset = np.array([-10.1,19])
-
-wells = [[f"""G0  Z{z_clearance}""", "G0 X150 Y50"],[f"""G0  Z{z_clearance}""", "G0 X170 Y50"],[f"""G0  Z{z_clearance}""", "G0 X190 Y50"]]
-dip = [f"""G0 Z{z_dip}""",f"""G0 Z{z_clearance}"""]    
-dot = [f"""G0 Z{z_transfer}""",f"""G0 Z{z_clearance}"""]    
-
-print("Initializing machine connection")
-with MachineConnection('/var/run/dsf/dcs.sock') as m:
-
-    for i in range(3):
-    
-        m.gcode(wells[0])
-        m.gcode(dip)    
-        m.move(origin + i * dx + offset)
-        m.gcode(dot)
-
-
-    m.gcode(wells[2])
-    m.gcode(dip)    
-    m.gcode(dip)    
-
-    
-    for i in range(3):
-    
-        m.gcode(wells[1])
-        m.gcode(dip)    
-        m.move(origin + i * dx + dy + offset)
-        m.gcode(dot)
-
-
-    m.move(origin, Z = cal['bed_focus'] + 0.3)
+from motion_planner import Planner, Stop, move_line
+
+# Runs a batch of transfers described by a job file: each transfer dips the
+# pin in a source well, then dots it onto a grid position of the plate located
+# by orient_plate.py (orientation.json). The whole job is planned up front and
+# streamed as one G-code program, with an M400 after each transfer - when its
+# reply arrives, the transfer is done, and that's recorded in a checkpoint file
+# so an interrupted job can be resumed where it left off.
+#
+# A job file looks like:
+#
+# {"wells": {"A": [150, 50], "B": [170, 50], "wash": [190, 50]},
+#  "transfers": [{"from": "A", "to": [[0, 0], [1, 0], [2, 0]]},
+#                {"from": "B", "to": [[0, 1], [1, 1], [2, 1]]}],
+#  "wash": {"well": "wash", "dips": 2}}
+#
+# "to" is a list of [column, row] plate positions. Transfers from each source are
+# done together, in the order the sources are listed, with the optional wash
+# between sources. Anything in the defaults below can be overridden as well.
+
+defaults = {'grid': [12, 7],            # columns and rows between the orientation's corners
+            'offset': [-10.1, 19],      # pin position relative to the camera
+            'clearance': 25,
+            'dip': 16,
+            'transfer': 13.75,
+            'wash': None}
+
+
+def load_job(path):
+    with open(path, "r") as f:
+        job = json.load(f)
+    return {**defaults, **job}
+
+
+def plate_positions(orientation, grid):
+    """ Returns a function mapping [column, row] to machine XY for the camera """
+    origin = np.array(orientation['origin'])
+    ll = np.array(orientation['ll'])
+    ur = np.array(orientation['ur'])
+    columns, rows = grid
+    dx = (ur - origin) / (columns - 1)
+    dy = (ll - origin) / (rows - 1)
+    return lambda position: origin + position[0] * dx + position[1] * dy
+
+
+class TransferJob:
+    """ A job file compiled into a list of steps, each a transfer (with any wash
+    needed before it) as G-code lines. """
+
+    def __init__(self, job, orientation):
+        self.job = job
+        self.planner = Planner(clearance = job['clearance'])
+        position = plate_positions(orientation, job['grid'])
+        offset = np.array(job['offset'])
+
+        # Wells are entered and left vertically from the clearance height
+        self.wells = {name: Stop(x, y, job['dip'], safe_z = job['clearance']) for name, (x, y) in job['wells'].items()}
+        self.transfers = []
+        for group in job['transfers']:
+            for to in group['to']:
+                xy = position(to) + offset
+                dot = Stop(float(xy[0]), float(xy[1]), job['transfer'])
+                self.transfers.append((group['from'], tuple(to), dot))
+
+        # Identifies the job and plate, so a checkpoint is only resumed by the same job
+        self.key = hashlib.sha1(json.dumps([job, orientation], sort_keys = True).encode()).hexdigest()
+
+    def order(self, start):
+        """ Plan the order of the transfers: source groups in job order, and
+        within each group whatever's quickest, starting from the (x, y, z) start """
+        order, here = [], start
+        sources = list(dict.fromkeys(source for source, _, _ in self.transfers))
+        for source in sources:
+            group = [i for i, (s, _, _) in enumerate(self.transfers) if s == source]
+            visits = [[self.wells[source], self.transfers[i][2]] for i in group]
+            order += [group[k] for k in self.planner.order(visits, start = here)]
+            last = self.transfers[order[-1]][2]
+            here = (last.x, last.y, last.z)
+        return order
+
+    def steps(self, order):
+        """ The visits for each transfer in order, washing between sources """
+        wash = self.job['wash']
+        steps, previous = [], None
+        for i in order:
+            source, _, dot = self.transfers[i]
+            visit = []
+            if wash is not None and previous is not None and source != previous:
+                visit += [self.wells[wash['well']]] * wash.get('dips', 1)
+            visit += [self.wells[source], dot]
+            steps.append(visit)
+            previous = source
+        return steps
+
+    def program(self, order, done = 0):
+        """ G-code for every step from done onwards, as a list of lines, and the
+        index of each step's closing M400 in it. We don't know where the machine
+        will be, so the first step goes up to the clearance height first. Each
+        step lifts the pin back to the clearance height before its M400, so a
+        finished step - and a checkpoint - never leaves it down on the plate. """
+        clearance = self.job['clearance']
+        steps = self.steps(order)[done:]
+        lines, marks = [], []
+        here = None
+        for visit in steps:
+            for _, stop, moves in self.planner.moves([visit], [0], here):
+                lines += [move_line(m) for m in moves]
+                here = stop
+            lines.append(move_line({'Z': clearance}))
+            here = Stop(here.x, here.y, clearance)
+            lines.append("M400")
+            marks.append(len(lines) - 1)
+        return lines, marks
+
+
+def load_checkpoint(path, job):
+    """ The saved order and number of transfers done, if path holds a checkpoint for this job """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('key') != job.key:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    # Write and rename, so a crash never leaves a half written checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def run_job(machine, job, checkpoint_path = None, progress = None):
+    """ Stream a TransferJob through a MachineConnection, resuming from
+    checkpoint_path if it holds a checkpoint for the same job. The checkpoint
+    is updated as each transfer finishes, and removed once they all have.
+
+    progress: optional progress(done, total), called after each transfer """
+
+    checkpoint = load_checkpoint(checkpoint_path, job)
+    if checkpoint is None:
+        checkpoint = {'key': job.key, 'order': job.order(tuple(machine.xyzu()[0:3])), 'done': 0}
+    order, done = checkpoint['order'], checkpoint['done']
+    total = len(order)
+
+    lines, marks = job.program(order, done)
+    finished = {mark: done + k + 1 for k, mark in enumerate(marks)}
+
+    def on_reply(index, result):
+        if index in finished:
+            checkpoint['done'] = finished[index]
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, checkpoint)
+            if progress is not None:
+                progress(checkpoint['done'], total)
+
+    if lines:
+        machine.gcode(lines, block = False, on_reply = on_reply)
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return checkpoint['done']
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: transfer.py <job file> [checkpoint file]")
+        exit()
+
+    job_path = sys.argv[1]
+    checkpoint_path = sys.argv[2] if len(sys.argv) > 2 else job_path + ".checkpoint"
+
+    with open("orientation.json") as f:
+        orientation = json.loads(f.read())
+
+    with open("camera_cal.json") as f:
+        cal = json.loads(f.read())
+
+    job = TransferJob(load_job(job_path), orientation)
+
+    print("Initializing machine connection")
+    with MachineConnection('/var/run/dsf/dcs.sock') as m:
+
+        def report(done, total):
+            print(f"""Transfer {done} of {total} done""")
+
+        if load_checkpoint(checkpoint_path, job) is not None:
+            print("Resuming from " + checkpoint_path)
+        run_job(m, job, checkpoint_path, report)
+
+        # Lift clear before travelling back, in case the job stopped part way
+        m.move(Z = job.job['clearance'])
+        m.move(orientation['origin'], Z = cal['bed_focus'] + 0.3)